@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+"""
+Measures how fast each collect mode of the collector retrieves a corpus
+from the stand-in news server (see standinNNTP.py), in articles per second.
+Every mode collects into a new project of its own, in a temporary directory.
+With -p it measures the header parsers of the collector instead, against
+their former versions, in header values per second. With -r it checks that
+retry recovers every article a faulty server failed to deliver, and with -k
+that a batch whose commit fails leaves no trace.
+"""
+import sys, getopt, os, re, time, tempfile, contextlib, io, operator
+import collectorNNTP, standinNNTP
+from collectorNNTP import yserial
+
+#mode name -> keyword arguments of NNTPDataset.download, or downloadAsync if "pipelining"
+MODES={
+    "head":dict(),
+    "head-workers":dict(workers=4),
+    "head-shards":dict(shards=4),
+    "head-msgids":dict(msgids=True),
+    "over":dict(overview=True),
+    "over-shards":dict(overview=True,shards=4),
+    "async-head":dict(pipelining=True),
+    "async-head-shards":dict(pipelining=True,shards=4),
+    "async-over":dict(pipelining=True,overview=True),
+}
+
+def legacyParseEmailAddress(addr):
+    """parseEmailAddress as it was before its pattern was compiled once and its results cached"""
+    collectorNNTP.debug("parsing e-mail",addr,level=3)
+    aman=addr
+    try:
+        r=re.compile("^(.*?)[\\s<]*(\\S+@\\S+)[>\\s]*(.*?)$")
+        n1,em,n2=r.findall(aman)[0]
+        n=n1.strip()+" "+n2.strip()
+        n=n.strip().lower()
+        for p in ["(",")","\"","'"]:n=n.replace(p,"")
+        em=em.replace(">","").replace("_REMOVE","").replace("REMOVE","").replace("/","")
+        x1,x2=em.split("@")
+    except:
+        x1,x2,n=aman.strip(),"",""
+    email=x1+"@"+x2
+    collectorNNTP.debug("Parsed email",addr,"to mail:",email,", name:",n,level=3)
+    return email
+
+def legacyTstampEpoch(tstamp):
+    """tstampEpoch as it was before RFC 2822 dates were parsed without dateutil"""
+    try:
+        return collectorNNTP.calendar.timegm(collectorNNTP.parser.parse(tstamp).utctimetuple())
+    except (ValueError,OverflowError,TypeError):
+        return None
+
+def legacyExtractHeaders(lines):
+    """The header loop of parseHead as it was before extractHeaders; None where it gave up on non-ASCII bytes"""
+    patterns={"date":"NNTP-Posting-Date:","sender":"From:","refs":"References:","xref":"Xref:"}
+    vals={}
+    try:
+        for h in lines:
+            h=h.decode("ascii")
+            for pk in patterns:
+                p=patterns[pk]
+                if h.find(p)==0:vals[pk]=h[len(p):].strip()
+    except UnicodeDecodeError:
+        return None
+    return vals
+
+def sameHeaders(former,current):
+    """
+    Tells if headers extracted by the former loop and by extractHeaders agree,
+    but for what the former did not handle: it gave up on non-ASCII bytes,
+    kept only the first line of folded headers and left encoded words as is
+    """
+    if former is None:
+        return True
+    for field,value in former.items():
+        if field=="sender":
+            if collectorNNTP.parseEmailAddress(value)!=collectorNNTP.parseEmailAddress(current.get(field,"")):
+                return False
+        elif not current.get(field,"").startswith(value):
+            return False
+    return True
+
+#parser name -> (header field, or None for all the raw header lines, former function, current function, results agree)
+PARSERS={
+    "address":("from",legacyParseEmailAddress,collectorNNTP.parseEmailAddress,operator.eq),
+    "tstamp":("nntp-posting-date",legacyTstampEpoch,collectorNNTP.tstampEpoch,operator.eq),
+    "headers":(None,legacyExtractHeaders,collectorNNTP.extractHeaders,sameHeaders),
+}
+
+def parsers(corpus,names=PARSERS,repeat=5):
+    """
+    Times each parser, former and current, on the values of its header field
+    in corpus, or on the header of each article, after checking that both
+    give the same results; returns
+    [(parser, values, former seconds, current seconds)], the best of 'repeat' runs
+    """
+    results=[]
+    for name in names:
+        field,former,current,agree=PARSERS[name]
+        if field is None: #as received, see standinNNTP.saveCorpus
+            values=[[line.encode("latin-1") for line in lines] for g in corpus.values() for lines in g["articles"].values()]
+        else:
+            values=[standinNNTP.unfold(lines).get(field,"") for g in corpus.values() for lines in g["articles"].values()]
+        for value in values:
+            if not agree(former(value),current(value)):
+                raise ValueError("%s parsers differ on %r: %r, %r"%(name,value,former(value),current(value)))
+        timings=[]
+        for function in (former,current):
+            best=None
+            for r in range(repeat):
+                if hasattr(function,"cache_clear"):function.cache_clear() #each run starts cold
+                started=time.perf_counter()
+                for value in values:function(value)
+                seconds=time.perf_counter()-started
+                best=seconds if best is None else min(best,seconds)
+            timings.append(best)
+        results.append((name,len(values),timings[0],timings[1]))
+    return results
+
+@contextlib.contextmanager
+def project(port,workdir,name,profile=collectorNNTP.PROFILE):
+    """Opens a new project, set up for the stand-in server at port; yields its dataset"""
+    collectorNNTP.storage=yserial.Main(os.path.join(workdir,name+".sqlite"),profile=profile).open()
+    try:
+        collectorNNTP.configureCodecs()
+        collectorNNTP.emailTable.ensure()
+        dataset=collectorNNTP.NNTPDataset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataset.setup("*",settings={"server":"127.0.0.1","port":str(port)})
+        yield dataset
+    finally:
+        collectorNNTP.storage.close()
+
+def collect(port,workdir,name,kw,profile=collectorNNTP.PROFILE):
+    """Sets up a project for the stand-in server at port and collects it; returns (seconds, emails)"""
+    with project(port,workdir,name,profile) as dataset:
+        kw=dict(kw)
+        started=time.time()
+        if kw.pop("pipelining",False):
+            dataset.downloadAsync(**kw)
+        else:
+            dataset.download(**kw)
+        return time.time()-started,collectorNNTP.emailTable.count()
+
+def missingArticles(dataset):
+    return sum(b-a+1 for gname in dataset["groups"] for a,b in dataset.getMissingSpans(gname))
+
+def checkRetry(corpus,modes=MODES,errors=0.2):
+    """
+    Collects corpus in each mode from a stand-in server failing a fraction
+    'errors' of article requests, then retries with the faults turned off;
+    returns [(mode, missing after collect, missing after retry, absent, emails)],
+    where 'absent' counts the article numbers the server does not have,
+    which are all that retry should leave missing
+    """
+    server=standinNNTP.StandinServer(corpus,0.0,0.0,errors,0.0,seed=1)
+    port=server.startThread()
+    absent=sum(g["last"]-g["first"]+1-len(g["articles"]) for g in corpus.values())
+    results=[]
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in modes:
+            with project(port,workdir,name) as dataset:
+                kw=dict(modes[name])
+                pipelining=kw.pop("pipelining",False)
+                server.errors=errors
+                if pipelining:
+                    dataset.downloadAsync(**kw)
+                else:
+                    dataset.download(**kw)
+                collected=missingArticles(dataset)
+                server.errors=0.0
+                dataset.retry(pipelining=pipelining,**kw)
+                results.append((name,collected,missingArticles(dataset),absent,collectorNNTP.emailTable.count()))
+    return results
+
+def benchmark(corpus,modes=MODES,latency=0.005,service=0.0,errors=0.0,drops=0.0):
+    """Runs the given modes against a stand-in server for corpus; returns [(mode, seconds, emails)]"""
+    server=standinNNTP.StandinServer(corpus,latency,service,errors,drops,seed=1)
+    port=server.startThread()
+    results=[]
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in modes:
+            seconds,emails=collect(port,workdir,name,modes[name])
+            results.append((name,seconds,emails))
+    return results
+
+def checkFlush():
+    """
+    Fails the commit of a batch, as when an export keeps the database busy,
+    then commits it with another one; returns [(sender, actor email)] of the
+    emails stored, where each actor email must be that of its sender
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        collectorNNTP.storage=yserial.Main(os.path.join(workdir,"flush.sqlite")).open()
+        try:
+            collectorNNTP.configureCodecs()
+            collectorNNTP.emailTable.ensure()
+            dataset=collectorNNTP.NNTPDataset()
+            dataset.setGroupPointer("check",1)
+            for table in ["groupspans","groupmissing"]:
+                collectorNNTP.storage.createtable(table)
+            writer=collectorNNTP.BatchWriter(size=10,interval=3600)
+            uniqueID,kw=dataset.makeEmail("check","<1@check>","Alice <alice@x>","Mon, 1 Jan 2001 10:00:00 +0000",[])
+            writer.addEmail(uniqueID,**kw)
+            upbatch=collectorNNTP.storage.upbatch
+            def busy(objseq,table):
+                if table=="grouppointers":
+                    raise IOError("database is locked")
+                return upbatch(objseq,table)
+            collectorNNTP.storage.upbatch=busy
+            writer.markDone("check",1)
+            try:
+                writer.flush()
+            except IOError:
+                pass
+            collectorNNTP.storage.upbatch=upbatch
+            uniqueID,kw=dataset.makeEmail("check","<2@check>","Bob <bob@x>","Mon, 1 Jan 2001 11:00:00 +0000",[])
+            writer.addEmail(uniqueID,**kw)
+            writer.flush()
+            actors=collectorNNTP.emailTable.actorEmails()
+            return [(sender,actors[actor]) for sender,actor in collectorNNTP.storage.iterrows("SELECT sender, actor FROM emailcols ORDER BY rowid")]
+        finally:
+            collectorNNTP.storage.close()
+
+def printHelp():
+    standinNNTP.debug("Usage: %s [-f corpus] [-g groups] [-n articles] [-l latency] [-s service] [-e errors] [-d drops] [mode ...]"%sys.argv[0])
+    standinNNTP.debug("   or: %s -p [-f corpus] [-g groups] [-n articles] [parser ...]"%sys.argv[0])
+    standinNNTP.debug("   or: %s -r errors [-f corpus] [-g groups] [-n articles] [mode ...]"%sys.argv[0])
+    standinNNTP.debug("   or: %s -k"%sys.argv[0])
+    standinNNTP.debug(" Collects the corpus in file 'corpus', or else a generated one of 'groups' groups (default 2) of about 'articles' articles each (default 1000), from a stand-in server whose responses take 'latency' seconds (default 0.005), see standinNNTP.py for the others.")
+    standinNNTP.debug(" Modes (default all):"," ".join(MODES))
+    standinNNTP.debug(" With -p, times the header parsers of the collector against their former versions instead. Parsers (default all):"," ".join(PARSERS))
+    standinNNTP.debug(" With -r, collects in each mode from a server failing a fraction 'errors' of article requests, retries without faults, and fails unless only the articles the server lacks are left missing.")
+    standinNNTP.debug(" With -k, fails a batch commit and then commits it again, and fails unless every email stored has its own sender's actor.")
+
+if __name__=="__main__":
+    fname,groups,articles=None,2,1000
+    latency,service,errors,drops=0.005,0.0,0.0,0.0
+    timeParsers,retryErrors,flushCheck=False,None,False
+    opts, args = getopt.getopt(sys.argv[1:], "f:g:n:l:s:e:d:pr:kh", [])
+    for o, a in opts:
+        if o == "-f":fname = a
+        elif o == "-g":groups = int(a)
+        elif o == "-n":articles = int(a)
+        elif o == "-l":latency = float(a)
+        elif o == "-s":service = float(a)
+        elif o == "-e":errors = float(a)
+        elif o == "-d":drops = float(a)
+        elif o == "-p":timeParsers = True
+        elif o == "-r":retryErrors = float(a)
+        elif o == "-k":flushCheck = True
+        elif o == "-h":
+            printHelp()
+            sys.exit(0)
+    for name in args:
+        if not name in (PARSERS if timeParsers else MODES):
+            printHelp()
+            sys.exit(1)
+    collectorNNTP.DEBUG=0
+    if flushCheck:
+        failed=False
+        for sender,actor in checkFlush():
+            print("%-30s %s"%(sender,actor))
+            failed=failed or actor!=collectorNNTP.actorEmail(sender)
+        sys.exit(1 if failed else 0)
+    corpus=standinNNTP.loadCorpus(fname) if fname else standinNNTP.syntheticCorpus(groups,articles)
+    total=sum(len(g["articles"]) for g in corpus.values())
+    if timeParsers:
+        print("%d articles in %d groups"%(total,len(corpus)))
+        print("%-20s %10s %14s %14s %8s"%("parser","values","former/s","current/s","speedup"))
+        for name,values,former,current in parsers(corpus,args or PARSERS):
+            print("%-20s %10d %14.1f %14.1f %8.1f"%(name,values,values/former,values/current,former/current))
+        sys.exit(0)
+    if retryErrors is not None:
+        print("%d articles in %d groups, errors %g"%(total,len(corpus),retryErrors))
+        print("%-20s %10s %10s %10s %10s"%("mode","missing","retried","absent","collected"))
+        failed=False
+        for name,missing,retried,absent,emails in checkRetry(corpus,{name:MODES[name] for name in args} if args else MODES,retryErrors):
+            print("%-20s %10d %10d %10d %10d"%(name,missing,retried,absent,emails))
+            failed=failed or retried!=absent or emails!=total
+        sys.exit(1 if failed else 0)
+    print("%d articles in %d groups, latency %gs, service %gs, errors %g, drops %g"%(total,len(corpus),latency,service,errors,drops))
+    print("%-20s %10s %10s %12s"%("mode","seconds","collected","articles/s"))
+    for name,seconds,emails in benchmark(corpus,{name:MODES[name] for name in args} if args else MODES,latency,service,errors,drops):
+        print("%-20s %10.2f %10d %12.1f"%(name,seconds,emails,emails/seconds))
@@ -4,13 +4,22 @@ This is a program for collecting datasets from a news (NNTP) server.
 The program can be interrupted, and restarted at any time.
 """
 import sys, getopt, re,  os, time, calendar, traceback, json, string, nntplib, os.path, pprint, datetime, time
-mypath=os.path.dirname(sys.argv[0])
+mypath=os.path.dirname(os.path.abspath(__file__))
 sys.path.append(mypath+os.path.sep+"yserial")
 import y_serial_v060py3 as yserial
+import threading, contextlib, concurrent.futures, asyncio, collections, fnmatch, functools, email.utils, email.header, email.errors
 from xml.etree.ElementTree import TreeBuilder, ElementTree
     
 DEBUG=1
 PERSISTENCE=os.path.expanduser("~/network-data-collector")
+BATCHSIZE=500 #emails per commit while collecting
+BATCHINTERVAL=10.0 #seconds between commits while collecting
+PROFILE="balanced" #SQLite performance profile of the project database, see yserial.Base.PROFILES
+MAXCONNECTIONS=4 #simultaneous connections to the news server, at most
+OVERRANGE=1000 #articles per OVER command when collecting from the overview database
+ZDICTSAMPLES=1000 #emails to train the compression dictionary of the emails table on
+PIPELINEWINDOW=32 #commands in flight per connection when collecting with asyncio
+MAXRATE=0 #requests per second to the news server, at most; 0 for no limit
 global storage
 
 def debug(*args,level=1,**kw):
@@ -32,32 +41,847 @@ except:
     debug("You do not have datautil installed! Aborting")
     sys.exit(1)
     
+EMAILPATTERN=re.compile("^(.*?)[\\s<]*(\\S+@\\S+)[>\\s]*(.*?)$") #name, address, name
+ADDRESSCACHE=65536 #distinct sender headers whose parsed address is remembered
+TSTAMPCACHE=65536 #distinct date headers whose parsed epoch is remembered
+
+@functools.lru_cache(maxsize=ADDRESSCACHE)
 def parseEmailAddress(addr):
     """
     Parses an email such as "John Smith <jsmith@example.com>" and 
-    returns the jsmith@example.com part
+    returns the jsmith@example.com part. Results are cached, as the same
+    sender appears on many messages.
     """
-    debug("parsing e-mail",addr,level=3)
-    aman=addr
-    #for p,r in [("<"," <"),(">","> "),("("," ("),(")",") ")]:
-    #    aman=aman.replace(p,r)
-    try:
-        r=re.compile("^(.*?)[\\s<]*(\\S+@\\S+)[>\\s]*(.*?)$")
-        n1,em,n2=r.findall(aman)[0]
-        n=n1.strip()+" "+n2.strip()
-        n=n.strip().lower()
-        for p in ["(",")","\"","'"]:n=n.replace(p,"")
-        em=em.replace(">","").replace("_REMOVE","").replace("REMOVE","").replace("/","")
-        x1,x2=em.split("@")
-    except:
-        x1,x2,n=aman.strip(),"",""
-    email=x1+"@"+x2
-    debug("Parsed email",addr,"to mail:",email,", name:",n,level=3)
-    return email
+    match=EMAILPATTERN.match(addr)
+    if match is None:
+        return addr.strip()+"@"
+    em=match.group(2).replace(">","").replace("_REMOVE","").replace("REMOVE","").replace("/","")
+    if em.count("@")!=1:
+        return addr.strip()+"@"
+    return em
+
+def actorEmail(email):
+    """Returns the form of a parsed sender address that identifies an actor: in lowercase, as addresses differ in case only by accident"""
+    return email.strip().lower()
+
+def parseEmailAddresses(addrs):
+    """Parses many sender headers at once, e.g. those of an OVER response; returns {header: email}"""
+    return {addr:parseEmailAddress(addr) for addr in set(addrs)}
+
+def groupMatcher(pattern,regex=False):
+    """
+    Returns a function telling if a group name matches pattern, which is a
+    regular expression if 'regex' is set, and else a wildmat as in NNTP's
+    LIST ACTIVE: comma separated wildcards, where those preceded by ! exclude
+    the groups they match, e.g. "gmane.comp.*,!gmane.comp.os.*"
+    """
+    if regex:
+        r=re.compile(pattern)
+        return lambda gname:r.search(gname) is not None
+    wildcards=[(w.startswith("!"),w.lstrip("!")) for w in pattern.split(",")]
+    def matches(gname):
+        found=False
+        for negated,w in wildcards:
+            if fnmatch.fnmatchcase(gname,w):found=not negated #the last matching wildcard decides
+        return found
+    return matches
+
+def configureCodecs():
+    """
+    Choose how each table's records are serialized in storage. Our records are
+    small dicts, for which zlib's default level costs CPU and saves little.
+    Emails are compressed with a dictionary trained on the project's own
+    records once there are enough of them; bookkeeping tables are not
+    compressed at all. Rows written with earlier settings stay readable.
+    """
+    if not storage.loadcodec("emails"):
+        samples=[]
+        try:
+            for x,(ign,mid,info) in storage.iterdic(table="emails"):
+                samples.append(info)
+                if len(samples)>=ZDICTSAMPLES:break
+        except IOError:
+            pass
+        if len(samples)>=ZDICTSAMPLES:
+            debug("Training compression dictionary on %d emails"%len(samples))
+            storage.traincodec("emails",samples)
+        else:
+            storage.setcodec("emails",yserial.Codec(level=1))
+    for table in ["actors","relations","acts"]:
+        storage.setcodec(table,yserial.Codec(level=1))
+    for table in ["dataset","grouppointers","groupspans","groupmissing"]:
+        storage.setcodec(table,yserial.Codec(level=0))
+    storage.setcodec("grouplist",yserial.Codec(level=1))
 
 def formatTstamp(ts):
     return str(ts)
     
+@functools.lru_cache(maxsize=TSTAMPCACHE)
+def tstampEpoch(tstamp):
+    """
+    Parses an email date header to integer seconds since the epoch (UTC),
+    or None if it cannot be parsed. RFC 2822 dates are parsed directly,
+    other forms by dateutil; a date without a timezone is taken as UTC.
+    """
+    parsed=email.utils.parsedate_tz(tstamp) if isinstance(tstamp,str) else None
+    if parsed is not None:
+        try:
+            return calendar.timegm(parsed[:6]+(0,0,0))-(parsed[9] or 0)
+        except (ValueError,OverflowError):
+            pass
+    try:
+        return calendar.timegm(parser.parse(tstamp).utctimetuple())
+    except (ValueError,OverflowError,TypeError):
+        return None
+
+#lowercase header name -> field, of the headers parseHead uses
+HEADERFIELDS={b"nntp-posting-date":"date",b"date":"sent",b"from":"sender",b"references":"refs",b"xref":"xref"}
+#overview fields parseOverview uses
+OVERVIEWFIELDS=("message-id","from","date","references","xref")
+
+@functools.lru_cache(maxsize=ADDRESSCACHE)
+def decodeWords(value):
+    """Decodes the RFC 2047 encoded words (=?charset?q?...?=) in a header value; cached like parseEmailAddress"""
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError,LookupError,UnicodeError):
+        return value #not really encoded words, keep as is
+
+def headerText(value,encoded=False):
+    """
+    Decodes a raw header value to text: bytes, or str as decoded by nntplib
+    (UTF-8 with surrogate escapes). Values are UTF-8, or else taken as latin-1.
+    If 'encoded' is set, RFC 2047 encoded words (=?charset?q?...?=) are
+    decoded too, as used in From: headers.
+    """
+    if isinstance(value,str):
+        if value.isascii():
+            if not encoded or not "=?" in value:return value
+        else:
+            value=value.encode("utf-8","surrogateescape")
+    if isinstance(value,bytes):
+        try:
+            value=value.decode("utf-8")
+        except UnicodeDecodeError:
+            value=value.decode("latin-1")
+    if encoded and "=?" in value:
+        value=decodeWords(value)
+    return value
+
+def extractHeaders(lines,fields=HEADERFIELDS):
+    """
+    Returns {field: text} for the headers named in fields among the raw header
+    lines (bytes) of an article, as from HEAD or a file. Continuation lines
+    are joined, and values decoded by headerText.
+    """
+    raw={}
+    field=None
+    get=fields.get
+    for line in lines:
+        if line[:1] in (b" ",b"\t"):
+            if field is not None:raw[field]+=b" "+line.strip()
+            continue
+        name,sep,value=line.partition(b":")
+        field=get(name.lower()) if sep else None
+        if field is not None:raw[field]=value.strip()
+    return {field:headerText(value,field=="sender") for field,value in raw.items()}
+
+def extractOverview(ov):
+    """Returns the fields of an overview, as from OVER, that parseOverview uses, decoded by headerText"""
+    return {name:headerText(ov[name],name=="from") for name in OVERVIEWFIELDS if name in ov}
+
+def epochDatetime(epoch):
+    """Returns the UTC datetime of an epoch as by tstampEpoch"""
+    return datetime.datetime.fromtimestamp(epoch,datetime.timezone.utc)
+
+class EmailTable:
+    """
+    Typed columns of the collected emails, kept beside the pickled records
+    of the 'emails' table so that filtering, reply joins and counts run as
+    SQL instead of unpickling every record. 'lastref' is the immediate parent
+    of a reply; all references are kept in a side table, in order. The
+    earliest and latest epoch of each group are kept up to date as well.
+    Every sender gets a dense integer actor id, in order of appearance, by
+    its address as normalized by actorEmail; the exports use these ids,
+    which are cached in memory once looked up.
+    """
+    COLUMNS="emailcols"
+    REFS="emailrefs"
+    BOUNDS="emailbounds"
+    ACTORS="emailactors"
+    VERSION=2 #PRAGMA user_version of a project whose derived tables are filled, see ensure
+    IDBATCH=500 #actor emails per query when looking up their ids
+
+    def __init__(self):
+        self.actorids={} #email -> actor id, of the actors looked up so far
+
+    def create(self):
+        storage.proceed("CREATE TABLE IF NOT EXISTS %s (uid TEXT PRIMARY KEY, gname TEXT, msgid TEXT, sender TEXT, tstamp TEXT, epoch INTEGER, lastref TEXT, actor INTEGER)"%self.COLUMNS)
+        storage.proceed("CREATE INDEX IF NOT EXISTS %s_msgid ON %s (gname, msgid)"%(self.COLUMNS,self.COLUMNS))
+        storage.proceed("CREATE INDEX IF NOT EXISTS %s_anygroup ON %s (msgid)"%(self.COLUMNS,self.COLUMNS))
+        storage.proceed("CREATE INDEX IF NOT EXISTS %s_sender ON %s (sender)"%(self.COLUMNS,self.COLUMNS))
+        storage.proceed("CREATE INDEX IF NOT EXISTS %s_epoch ON %s (epoch)"%(self.COLUMNS,self.COLUMNS))
+        storage.proceed("CREATE TABLE IF NOT EXISTS %s (uid TEXT, pos INTEGER, ref TEXT, PRIMARY KEY (uid, pos))"%self.REFS)
+        storage.proceed("CREATE INDEX IF NOT EXISTS %s_ref ON %s (ref)"%(self.REFS,self.REFS))
+        storage.proceed("CREATE TABLE IF NOT EXISTS %s (gname TEXT PRIMARY KEY, mint INTEGER, maxt INTEGER)"%self.BOUNDS)
+        storage.proceed("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, email TEXT UNIQUE)"%self.ACTORS)
+
+    def ensure(self):
+        """Create the tables, and fill them from the 'emails' table if they lag behind it"""
+        self.create()
+        self.actorids={} #a project was opened, forget those of any other
+        if self.version()<1: #projects indexed by older versions lack the bounds
+            with self.transaction():
+                storage.proceed("DELETE FROM %s"%self.BOUNDS)
+                storage.proceed("""INSERT INTO %s SELECT gname, MIN(epoch), MAX(epoch)
+                        FROM %s WHERE epoch IS NOT NULL GROUP BY gname"""%(self.BOUNDS,self.COLUMNS))
+                storage.proceed("PRAGMA user_version = 1")
+        if self.version()<2: #and the actor ids, or kept them by the address as parsed
+            with self.transaction():
+                if not "actor" in [column for cid,column,*rest in list(storage.iterrows("PRAGMA table_info(%s)"%self.COLUMNS))]:
+                    storage.proceed("ALTER TABLE %s ADD COLUMN actor INTEGER"%self.COLUMNS)
+                storage.proceed("DELETE FROM %s"%self.ACTORS)
+                senders=[sender for (sender,) in list(storage.iterrows("SELECT sender FROM %s GROUP BY sender ORDER BY MIN(rowid)"%self.COLUMNS))]
+                storage.proceed("UPDATE %s SET actor = ? WHERE sender = ?"%self.COLUMNS,list(zip(self.actorIds(senders),senders)))
+                storage.proceed("PRAGMA user_version = 2")
+        try:
+            stored=storage.shout("COUNT(DISTINCT notes)","emails")
+        except IOError:
+            return
+        if self.count()<stored:
+            debug("Indexing %d collected emails"%stored)
+            batch=[]
+            with self.transaction():
+                for x,(ign,uid,info) in storage.iterdic(table="emails"):
+                    batch.append((info,uid))
+                    if len(batch)>=BATCHSIZE:
+                        self.add(batch)
+                        batch=[]
+                self.add(batch)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        A storage transaction which forgets the actor ids looked up within it
+        if it rolls back, as they may name actors which were never committed
+        """
+        try:
+            with storage.transaction():
+                yield
+        except BaseException:
+            self.actorids={}
+            raise
+
+    def version(self):
+        """Returns how far the tables of the project have been brought up to date, up to VERSION"""
+        for (version,) in list(storage.iterrows("PRAGMA user_version")):
+            return version
+
+    def add(self,emails):
+        """Adds (info, uniqueID) pairs, as stored in the 'emails' table"""
+        rows=[]
+        refrows=[]
+        bounds={}
+        actors=self.actorIds([info["senderemail"] for info,uid in emails])
+        for (info,uid),actor in zip(emails,actors):
+            refs=info["references"]
+            epoch=info["epoch"] if "epoch" in info else tstampEpoch(info["tstamp"])
+            rows.append([uid,info["gname"],info["msgid"],info["senderemail"],info["tstamp"],epoch,refs[-1] if refs else None,actor])
+            refrows.extend([uid,pos,ref] for pos,ref in enumerate(refs))
+            if epoch is not None:
+                mint,maxt=bounds.get(info["gname"],(epoch,epoch))
+                bounds[info["gname"]]=(min(mint,epoch),max(maxt,epoch))
+        storage.proceed("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?)"%self.COLUMNS,rows)
+        storage.proceed("DELETE FROM %s WHERE uid = ?"%self.REFS,[[r[0]] for r in rows])
+        storage.proceed("INSERT OR REPLACE INTO %s VALUES (?, ?, ?)"%self.REFS,refrows)
+        storage.proceed("""INSERT INTO %s VALUES (?, ?, ?) ON CONFLICT (gname)
+                DO UPDATE SET mint = MIN(mint, excluded.mint), maxt = MAX(maxt, excluded.maxt)"""%self.BOUNDS,
+                [[gname,mint,maxt] for gname,(mint,maxt) in bounds.items()])
+
+    def actorIds(self,emails):
+        """Returns the actor id of each sender address, giving new actors the next ids"""
+        emails=[actorEmail(email) for email in emails]
+        new=[email for email in dict.fromkeys(emails) if not email in self.actorids]
+        if new:
+            storage.proceed("INSERT OR IGNORE INTO %s (email) VALUES (?)"%self.ACTORS,[[email] for email in new])
+            for n in range(0,len(new),self.IDBATCH):
+                batch=new[n:n+self.IDBATCH]
+                self.actorids.update((email,id) for id,email in list(storage.iterrows(
+                    "SELECT id, email FROM %s WHERE email IN (%s)"%(self.ACTORS,", ".join("?"*len(batch))),batch)))
+        return [self.actorids[email] for email in emails]
+
+    def actorEmails(self):
+        """Returns the list of actor emails, indexed by actor id (index 0 is unused)"""
+        emails=[None]
+        for id,email in storage.iterrows("SELECT id, email FROM %s ORDER BY id"%self.ACTORS):
+            emails.extend([None]*(id-len(emails)))
+            emails.append(email)
+            self.actorids[email]=id
+        return emails
+
+    def count(self):
+        for (n,) in storage.iterrows("SELECT COUNT(*) FROM %s"%self.COLUMNS):
+            return n
+
+    def msgids(self):
+        """Yields the Message-IDs collected, in any group"""
+        for (msgid,) in storage.iterrows("SELECT DISTINCT msgid FROM %s"%self.COLUMNS):
+            yield msgid
+
+    def findByMsgid(self,msgid):
+        """Returns the uniqueID of an email with Message-ID msgid, in any group, or None"""
+        for (uid,) in list(storage.iterrows("SELECT uid FROM %s WHERE msgid = ? LIMIT 1"%self.COLUMNS,[msgid])):
+            return uid
+        return None
+
+    def countByGroup(self):
+        return dict(storage.iterrows("SELECT gname, COUNT(*) FROM %s GROUP BY gname"%self.COLUMNS))
+
+    def minMaxEpoch(self,gname=None):
+        """Returns the (earliest, latest) epoch of the emails of group gname, or of all groups; (None, None) if there are none"""
+        if gname is not None:
+            for mint,maxt in list(storage.iterrows("SELECT mint, maxt FROM %s WHERE gname = ?"%self.BOUNDS,[gname])):
+                return mint,maxt
+            return None,None
+        for mint,maxt in storage.iterrows("SELECT MIN(mint), MAX(maxt) FROM %s"%self.BOUNDS):
+            return mint,maxt
+
+    def iterReplies(self):
+        """
+        Yields (gname, msgid, sender, tstamp, epoch, lastref, recipient, senderid,
+        recipientid) for each email, where recipient is the sender of the parent
+        email, or None if the email is not a reply (lastref is None) or its
+        parent was not collected; the ids are their actor ids
+        """
+        for row in storage.iterrows("""SELECT e.gname, e.msgid, e.sender, e.tstamp, e.epoch, e.lastref, p.sender, e.actor, p.actor
+                FROM %s e LEFT JOIN %s p ON p.gname = e.gname AND p.msgid = e.lastref
+                ORDER BY e.rowid"""%(self.COLUMNS,self.COLUMNS)):
+            yield row
+
+emailTable=EmailTable()
+
+def parseXref(xref):
+    """Returns [(gname, number)] of an Xref header such as "news.example.com group.a:12 group.b:40" """
+    places=[]
+    for place in xref.split()[1:]:
+        gname,sep,number=place.rpartition(":")
+        if sep and number.isdigit():
+            places.append((gname,int(number)))
+    return places
+
+class RangeSet:
+    """
+    A set of integers, such as article numbers, kept compactly as a sorted
+    list of merged, inclusive [first, last] spans
+    """
+    def __init__(self,spans=()):
+        self.spans=[]
+        for first,last in spans:
+            self.add(first,last)
+
+    def find(self,n):
+        """Index of the first span whose last number is at least n"""
+        lo,hi=0,len(self.spans)
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self.spans[mid][1]<n:lo=mid+1
+            else:hi=mid
+        return lo
+
+    def add(self,first,last=None):
+        if last is None:last=first
+        spans=self.spans
+        if spans and spans[-1][0]<=first<=spans[-1][1]+1:
+            spans[-1][1]=max(spans[-1][1],last) #the common case: numbers come in ascending order
+            return
+        i=self.find(first-1)
+        j=i
+        while j<len(spans) and spans[j][0]<=last+1:
+            first=min(first,spans[j][0])
+            last=max(last,spans[j][1])
+            j+=1
+        spans[i:j]=[[first,last]]
+
+    def discard(self,first,last=None):
+        if last is None:last=first
+        spans=self.spans
+        i=self.find(first)
+        j=i
+        rest=[]
+        while j<len(spans) and spans[j][0]<=last:
+            if spans[j][0]<first:rest.append([spans[j][0],first-1])
+            if spans[j][1]>last:rest.append([last+1,spans[j][1]])
+            j+=1
+        spans[i:j]=rest
+
+    def __contains__(self,n):
+        i=self.find(n)
+        return i<len(self.spans) and self.spans[i][0]<=n
+
+    def __len__(self):
+        return sum(last-first+1 for first,last in self.spans)
+
+    def __iter__(self):
+        for first,last in self.spans:
+            yield first,last
+
+    def missing(self,first,last):
+        """Returns the spans of first..last which are not in this set"""
+        gaps=[]
+        for a,b in self.spans[self.find(first):]:
+            if a>last:break
+            if a>first:gaps.append((first,a-1))
+            first=max(first,b+1)
+        if first<=last:gaps.append((first,last))
+        return gaps
+
+    def advance(self,pointer):
+        """
+        Removes the spans starting at or below pointer, and returns the pointer
+        moved past them, i.e. the first number not in the set from pointer on
+        """
+        while self.spans and self.spans[0][0]<=pointer:
+            pointer=max(pointer,self.spans.pop(0)[1]+1)
+        return pointer
+
+def splitSpans(spans,n):
+    """Splits a list of (first, last) spans into n lists holding about equally many numbers"""
+    total=sum(b-a+1 for a,b in spans)
+    size=max(1,-(-total//n))
+    shards=[[]]
+    room=size
+    for a,b in spans:
+        while a<=b:
+            if room==0:
+                shards.append([])
+                room=size
+            end=min(b,a+room-1)
+            shards[-1].append((a,end))
+            room-=end-a+1
+            a=end+1
+    return [shard for shard in shards if shard]
+
+class BatchWriter:
+    """
+    Buffers collected emails and writes them, together with the collection
+    progress of their groups, in a single transaction once 'size' emails are
+    pending or 'interval' seconds have passed since the last commit. Since
+    progress is only ever committed with the emails before it, a crashed run
+    resumes from the last committed batch.
+    Progress of a group is its pointer (all articles below are done) plus
+    a RangeSet of completed spans above it, which concurrent shards of the
+    group leave behind; the pointer moves up as the spans join it.
+    Articles which could not be retrieved are kept in another RangeSet per
+    group, for the 'retry' command.
+    If 'msgids' is set, it also answers which Message-IDs were collected
+    already, in any group, from a set loaded when first needed.
+    """
+    def __init__(self,size=BATCHSIZE,interval=BATCHINTERVAL,msgids=False):
+        self.size=size
+        self.interval=interval
+        self.msgids=msgids
+        self.collected=None #Message-IDs collected before this run, if msgids
+        self.recent={} #msgid -> fields of the emails added since the last flush
+        self.emails=[]
+        self.done={} #gname -> RangeSet of completed articles above the pointer
+        self.missing={} #gname -> RangeSet of articles which could not be retrieved
+        self.pointers={}
+        self.dirty=set()
+        self.lastflush=time.time()
+        self.committed=0
+        self.lock=threading.RLock() #shared by the collecting threads
+
+    def addEmail(self,uniqueID,**kw):
+        with self.lock:
+            self.emails.append((kw,uniqueID))
+            self.recent[kw["msgid"]]=kw
+            if self.collected is not None:
+                self.collected.add(kw["msgid"])
+            debug("Added ",uniqueID,kw,level=2)
+            self.flushIfDue()
+
+    def knownEmail(self,msgid):
+        """Returns the fields of an email with Message-ID msgid collected in any group, or None"""
+        with self.lock:
+            if msgid in self.recent:
+                return self.recent[msgid]
+            if self.collected is None:
+                self.collected=set(emailTable.msgids())
+            if not msgid in self.collected:
+                return None
+        uid=emailTable.findByMsgid(msgid)
+        return storage.get(uid,"emails") if uid else None
+
+    def load(self,gname):
+        if not gname in self.done:
+            self.pointers[gname]=storage.get(gname,"grouppointers")
+            self.done[gname]=RangeSet(storage.get(gname,"groupspans") or [])
+            self.missing[gname]=RangeSet(storage.get(gname,"groupmissing") or [])
+
+    def isDone(self,gname,number):
+        """Tells if article 'number' of group gname is collected already; articles which could not be retrieved are not"""
+        with self.lock:
+            self.load(gname)
+            if number in self.missing[gname]:
+                return False #for retry to request it again
+            return number<self.pointers[gname] or number in self.done[gname]
+
+    def markDone(self,gname,number,found=True):
+        """Records that article 'number' of group gname was collected, or was not 'found'"""
+        with self.lock:
+            self.load(gname)
+            self.done[gname].add(number)
+            if not found:
+                self.missing[gname].add(number)
+            elif number in self.missing[gname]:
+                self.missing[gname].discard(number) #found by a retry
+            self.dirty.add(gname)
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        if len(self.emails)>=self.size or time.time()-self.lastflush>=self.interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.emails or self.dirty:
+                pointers=[]
+                spans=[]
+                missing=[]
+                for gname in self.dirty:
+                    self.pointers[gname]=self.done[gname].advance(self.pointers[gname])
+                    pointers.append((self.pointers[gname],gname))
+                    spans.append((list(self.done[gname]),gname))
+                    missing.append((list(self.missing[gname]),gname))
+                with emailTable.transaction():
+                    storage.upbatch(self.emails,"emails")
+                    emailTable.add(self.emails)
+                    storage.upbatch(pointers,"grouppointers")
+                    storage.upbatch(spans,"groupspans")
+                    storage.upbatch(missing,"groupmissing")
+                self.committed+=len(self.emails)
+                debug("Committed batch of %d emails (%d in total)"%(len(self.emails),self.committed),level=2)
+            self.emails=[]
+            self.recent={}
+            self.dirty=set()
+            self.lastflush=time.time()
+
+class RateController:
+    """
+    Paces the requests sent to the news server, over all its connections.
+    At most 'window' requests are outstanding at a time, where 'window'
+    adapts AIMD style: it grows by one per window of good responses, and
+    halves when a request fails (e.g. the server drops or throttles us) or
+    takes far longer than the fastest responses seen. On top of that no
+    more than 'maxrate' requests are started per second, if it is set.
+    Threads use request(), coroutines arequest().
+    """
+    SLOWDOWN=4.0 #latency, relative to the fastest seen, which counts as congestion
+    MISSING=("423","430") #responses for articles which are not there, which are no failures
+
+    def __init__(self,maxwindow=1,maxrate=MAXRATE):
+        self.maxwindow=maxwindow
+        self.window=float(maxwindow) #start at the configured concurrency, back off on trouble
+        self.maxrate=maxrate
+        self.active=0
+        self.next=0.0 #earliest start of the next request under maxrate
+        self.fastest=None
+        self.lastdecrease=0.0
+        self.completed=collections.deque() #completion times over the last seconds, for the rate
+        self.failures=0
+        self.cond=threading.Condition()
+
+    def tryStart(self):
+        """Starts a request if allowed and returns 0, or else returns the seconds to wait"""
+        with self.cond:
+            now=time.monotonic()
+            if self.active>=int(self.window):
+                return (self.fastest or 0.01)/max(1,self.active)
+            if self.maxrate:
+                if now<self.next:
+                    return self.next-now
+                self.next=max(self.next,now-1.0/self.maxrate)+1.0/self.maxrate
+            self.active+=1
+            return 0
+
+    def finish(self,started,failed):
+        """Ends a request started at 'started', adapting the window to how it went"""
+        with self.cond:
+            now=time.monotonic()
+            latency=now-started
+            self.active-=1
+            self.completed.append(now)
+            while self.completed[0]<now-5.0:
+                self.completed.popleft()
+            if not failed and (self.fastest is None or latency<self.fastest):
+                self.fastest=latency
+            if failed or latency>self.SLOWDOWN*self.fastest:
+                self.failures+=failed
+                if now-self.lastdecrease>latency: #once per round trip
+                    self.window=max(1.0,self.window/2)
+                    self.lastdecrease=now
+            else:
+                self.window=min(self.maxwindow,self.window+1.0/self.window)
+            self.cond.notify()
+
+    def failed(self,e):
+        if isinstance(e,nntplib.NNTPTemporaryError):
+            return not str(e)[:3] in self.MISSING
+        return isinstance(e,(nntplib.NNTPError,OSError,EOFError))
+
+    @contextlib.contextmanager
+    def request(self):
+        while True:
+            with self.cond:
+                wait=self.tryStart()
+                if not wait:break
+                self.cond.wait(wait)
+        started,failed=time.monotonic(),False
+        try:
+            yield
+        except Exception as e:
+            failed=self.failed(e)
+            raise
+        finally:
+            self.finish(started,failed)
+
+    @contextlib.asynccontextmanager
+    async def arequest(self):
+        while True:
+            wait=self.tryStart()
+            if not wait:break
+            await asyncio.sleep(wait)
+        started,failed=time.monotonic(),False
+        try:
+            yield
+        except Exception as e:
+            failed=self.failed(e)
+            raise
+        finally:
+            self.finish(started,failed)
+
+    def status(self):
+        with self.cond:
+            if len(self.completed)<2:
+                return ""
+            rate=(len(self.completed)-1)/max(0.001,self.completed[-1]-self.completed[0])
+            return "(%.1f requests/s, %d in flight at most, %d failed)"%(rate,self.window,self.failures)
+
+class ControlledServer:
+    """An nntplib connection whose article requests are paced by a RateController"""
+    def __init__(self,server,controller):
+        self.server=server
+        self.controller=controller
+
+    def head(self,*args):
+        with self.controller.request():
+            return self.server.head(*args)
+
+    def over(self,*args):
+        with self.controller.request():
+            return self.server.over(*args)
+
+    def xhdr(self,*args):
+        with self.controller.request():
+            return self.server.xhdr(*args)
+
+    def __getattr__(self,name):
+        return getattr(self.server,name)
+
+class ConnectionLimit:
+    """
+    Caps the number of simultaneous connections to the news server, since
+    servers refuse clients that open too many. Article requests over the
+    connections are paced by 'controller', if given.
+    """
+    def __init__(self,dataset,limit=MAXCONNECTIONS,controller=None):
+        self.dataset=dataset
+        self.slots=threading.BoundedSemaphore(limit)
+        self.controller=controller
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Connects to the server once a slot is free, and quits when done"""
+        with self.slots:
+            server=self.dataset.getServer()
+            try:
+                yield ControlledServer(server,self.controller) if self.controller else server
+            finally:
+                try:
+                    server.quit()
+                except (nntplib.NNTPError,OSError,EOFError):
+                    pass
+
+class AsyncNNTP:
+    """
+    A small asyncio NNTP client which pipelines commands: up to 'window'
+    commands are sent ahead of their responses, which the server returns
+    in the order of the commands (RFC 3977, section 3.5). Responses are
+    shaped like those of nntplib, as the collector uses them.
+    """
+    OVERFMT=["subject","from","date","message-id","references",":bytes",":lines"]
+
+    def __init__(self,window=PIPELINEWINDOW,controller=None):
+        self.window=asyncio.Semaphore(window)
+        self.controller=controller #paces HEAD and OVER, see RateController
+        self.pending=collections.deque() #(future, multiline) of commands sent, in order
+        self.arrived=asyncio.Event()
+        self.reader=self.writer=self.receiver=None
+        self.overfmt=self.OVERFMT
+
+    async def connect(self,host,port,username=None,password=None):
+        self.reader,self.writer=await asyncio.open_connection(host,port)
+        self.checkResponse(await self.readline())
+        self.receiver=asyncio.ensure_future(self.receive())
+        if username:
+            resp,lines=await self.command("AUTHINFO USER "+username,ok=("281","381"))
+            if resp.startswith("381"): #281: accepted without a password
+                await self.command("AUTHINFO PASS "+password,ok="281")
+        try:
+            await self.command("MODE READER")
+        except nntplib.NNTPPermanentError:
+            pass
+        return self
+
+    async def readline(self):
+        line=await self.reader.readline()
+        if not line:
+            raise EOFError("connection closed by the news server")
+        return line.rstrip(b"\r\n")
+
+    async def readlines(self):
+        lines=[]
+        while True:
+            line=await self.readline()
+            if line==b".":
+                return lines
+            if line.startswith(b".."):line=line[1:]
+            lines.append(line)
+
+    def checkResponse(self,line):
+        resp=line.decode("utf-8","surrogateescape")
+        if resp[:1]=="4":
+            raise nntplib.NNTPTemporaryError(resp)
+        if resp[:1]=="5":
+            raise nntplib.NNTPPermanentError(resp)
+        if resp[:1] not in "123":
+            raise nntplib.NNTPProtocolError(resp)
+        return resp
+
+    async def receive(self):
+        """Reads the responses, in order, for the commands sent"""
+        try:
+            while True:
+                while not self.pending:
+                    self.arrived.clear()
+                    await self.arrived.wait()
+                future,multiline=self.pending[0]
+                try:
+                    resp=self.checkResponse(await self.readline())
+                    result=(resp,await self.readlines() if multiline else [])
+                except (nntplib.NNTPTemporaryError,nntplib.NNTPPermanentError) as e:
+                    result=e #fails this command only
+                self.pending.popleft()
+                if not future.done():
+                    if isinstance(result,Exception):future.set_exception(result)
+                    else:future.set_result(result)
+        except Exception as e:
+            debug("Lost connection to the news server:",repr(e),level=2)
+            while self.pending:
+                future,multiline=self.pending.popleft()
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception() #commands cancelled meanwhile never await it
+
+    async def command(self,line,multiline=False,ok=None):
+        """Sends a command and returns its (response, lines) once it arrives"""
+        async with self.window:
+            if self.receiver.done():
+                raise EOFError("connection to the news server is lost")
+            future=asyncio.get_running_loop().create_future()
+            self.writer.write(line.encode("utf-8")+b"\r\n")
+            self.pending.append((future,multiline))
+            self.arrived.set()
+            await self.writer.drain()
+            resp,lines=await future
+        if ok and not resp.startswith(ok):
+            raise nntplib.NNTPReplyError(resp)
+        return resp,lines
+
+    async def group(self,gname):
+        resp,lines=await self.command("GROUP "+gname)
+        words=resp.split()
+        return resp,int(words[1]),int(words[2]),int(words[3]),gname
+
+    async def paced(self,line,multiline=False):
+        if not self.controller:
+            return await self.command(line,multiline)
+        async with self.controller.arequest():
+            return await self.command(line,multiline)
+
+    async def head(self,i):
+        resp,lines=await self.paced("HEAD %d"%i,multiline=True)
+        words=resp.split()
+        return resp,nntplib.ArticleInfo(int(words[1]),words[2],lines)
+
+    async def xhdr(self,field,numbers):
+        """Returns (response, [(number, value)]) of a header field of articles first..last"""
+        resp,lines=await self.paced("XHDR %s %d-%d"%((field,)+numbers),multiline=True)
+        values=[]
+        for line in lines:
+            number,sep,value=line.decode("utf-8","surrogateescape").partition(" ")
+            values.append((int(number),value.strip()))
+        return resp,values
+
+    async def loadOverviewFormat(self):
+        try:
+            resp,lines=await self.command("LIST OVERVIEW.FMT",multiline=True)
+        except nntplib.NNTPPermanentError:
+            return
+        fmt=[]
+        for line in lines:
+            name=line.decode("ascii").lower()
+            if name.endswith(":full"):name=name[:-5]
+            fmt.append(name if name.startswith(":") else name.rstrip(":"))
+        self.overfmt=fmt
+
+    async def over(self,numbers):
+        """Returns (response, [(number, {field: value})]) for articles first..last"""
+        resp,lines=await self.paced("OVER %d-%d"%numbers,multiline=True)
+        overviews=[]
+        for line in lines:
+            values=line.decode("utf-8","surrogateescape").split("\t")
+            fields={}
+            for n,(name,value) in enumerate(zip(self.overfmt,values[1:])):
+                if n>=len(self.OVERFMT) and value.lower().startswith(name+":"):
+                    value=value[len(name)+1:].strip() #full fields repeat their name
+                fields[name]=value
+            overviews.append((int(values[0]),fields))
+        return resp,overviews
+
+    async def quit(self):
+        try:
+            if self.receiver and not self.receiver.done():
+                await asyncio.wait_for(self.command("QUIT"),5)
+        except (nntplib.NNTPError,OSError,EOFError,asyncio.TimeoutError):
+            pass
+        finally:
+            if self.receiver:self.receiver.cancel()
+            if self.writer:self.writer.close()
+
+async def pipelined(aws,depth):
+    """Runs the awaitables at most 'depth' ahead, yielding their results in order"""
+    pending=collections.deque()
+    try:
+        for aw in aws:
+            pending.append(asyncio.ensure_future(aw))
+            if len(pending)>=depth:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:future.cancel()
+
 class NNTPDataset(dict):
     """
     Represents a dataset collected from a news (NNTP) server, 
@@ -66,7 +890,7 @@ class NNTPDataset(dict):
     """
     @classmethod
     def restore(cls):
-        dataset= storage.select("dataset","dataset")
+        dataset= storage.get("dataset","dataset")
         #pprint.pprint(dataset)
         return dataset
     
@@ -75,18 +899,38 @@ class NNTPDataset(dict):
         self.actors=None
     
     def persist(self):
-        storage.insert(self,"dataset","dataset")
+        storage.put("dataset",self,"dataset")
     
-    def setup(self):
+    def compact(self):
+        """
+        Drop superseded rows left by earlier versions, which appended a row
+        for every write of the dataset and group pointers, then vacuum.
+        """
+        for table in ["dataset","grouppointers","groupspans","groupmissing","emails","actors","relations","acts"]:
+            try:
+                storage.compact(table)
+                debug("Compacted",table)
+            except IOError:
+                debug("No table to compact:",table,level=2)
+        storage.vacuum()
+
+    def setup(self,pattern=None,regex=False,refresh=False,settings={}):
         """
         (Re-)setup the information necessary prior to connecting to server
         (such as server host, port, username and password) and 
         retrieving selected mailgroups (i.e. asks which mailgroups to
         retrieve).
+        If a group 'pattern' is given (see groupMatcher), nothing is asked:
+        'settings' are taken over, and all groups matching are selected.
+        The server's group list is cached, see getGroupList; 'refresh' 
+        downloads it anew.
         """
         def askSetting(s,default=None,convert=str):
             if s in self and self[s]:default=self[s]
-            tmp=input(s+" (default: %s) :"%default)
+            if pattern:
+                tmp=settings.get(s)
+            else:
+                tmp=input(s+" (default: %s) :"%default)
             if tmp:
                 self[s]=convert(tmp)
             else:
@@ -104,39 +948,83 @@ class NNTPDataset(dict):
                 print(gname," (number of messages: %d)"%(g["last"]-g["first"]+1))
         else:
             print("No groups were selected for download yet")
-            
-        tmp=input("Will get a list of mailgroups at server. Press ENTER to continue, or enter 'no' to skip:")
-        if not tmp:
-            resp,glist=self.getServer().list()
-            ginfo={}
-            for g,last,first,flag in glist:
-                gname=g.decode("ascii")
-                ilast=int(last.decode("ascii"))
-                ifirst=int(first.decode("ascii"))
-                print(gname, "(number of messages: %d)"%(ilast-ifirst+1))
-                ginfo[gname]={"last":ilast,"first":ifirst}
-            
-        print("Enter the group names you want to collect, finish with an empty line")
-        while True:
-            gname=input("Enter group name:").strip()
-            if not gname:break
-            if not gname in groups:
-                groups[gname]=ginfo[gname]
-                self.setGroupPointer(gname, ginfo[gname]["first"])
-        self["groups"]=groups
-        self.persist()
+
+        with ConnectionLimit(self,1).connection() as server:
+            if pattern:
+                ginfo=self.getGroupList(server,pattern,regex,refresh)
+                selected=sorted(ginfo)
+            else:
+                tmp=input("Will get a list of mailgroups at server. Enter a pattern to list only matching groups (e.g. gmane.comp.python.*), press ENTER to list all, or enter 'no' to skip:").strip()
+                ginfo={}
+                if tmp!="no":
+                    ginfo=self.getGroupList(server,tmp or None,refresh=refresh)
+                    for gname in sorted(ginfo):
+                        print(gname, "(number of messages: %d)"%(ginfo[gname]["last"]-ginfo[gname]["first"]+1))
+                print("Enter the group names you want to collect, finish with an empty line")
+                selected=[]
+                while True:
+                    gname=input("Enter group name:").strip()
+                    if not gname:break
+                    if not gname in ginfo:
+                        try:
+                            resp,count,first,last,name=server.group(gname)
+                        except nntplib.NNTPTemporaryError as e:
+                            print("No such group:",gname)
+                            continue
+                        ginfo[gname]={"first":first,"last":last}
+                    selected.append(gname)
+            for gname in selected:
+                if not gname in groups:
+                    groups[gname]=dict(ginfo[gname])
+                    self.setGroupPointer(gname, ginfo[gname]["first"])
+                    print("Selected",gname)
+            self["groups"]=groups
+            self.refreshGroups(server) #cached bounds may be out of date
         print("Setup is completed.")
 
-    def getMinMaxTstamp(self):
-        mint=None
-        maxt=None
-        tstamps=[]
-        c=0
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
-            c+=1
-            debug("Checking timestamps %d"%c,level=2,progress=True)
-            tstamps.append(parser.parse(info["tstamp"]))
-        return min(tstamps),max(tstamps)
+    def getGroupList(self,server,pattern=None,regex=False,refresh=False):
+        """
+        Returns {gname: {"first": first, "last": last}} for the groups at the
+        server which match pattern (see groupMatcher), or all groups. The
+        full list is cached in the 'grouplist' table, and later brought up
+        to date with NEWGROUPS instead of being downloaded again, unless
+        'refresh' is set. Article numbers in the cached list may be out of
+        date. Without a cached list, a wildmat pattern is passed on to the
+        server (LIST ACTIVE pattern), which spares downloading all groups.
+        """
+        storage.createtable("grouplist")
+        cached=None if refresh else storage.get(self["server"],"grouplist")
+        if cached is None and pattern and not regex:
+            try:
+                resp,glist=server.list(pattern)
+                matches=groupMatcher(pattern)
+                return {g.group:{"first":int(g.first),"last":int(g.last)} for g in glist if matches(g.group)}
+            except nntplib.NNTPPermanentError as e:
+                debug("Server does not filter group lists, getting all groups:",e,level=2)
+        try:
+            resp,now=server.date() #the server's clock, for NEWGROUPS
+        except nntplib.NNTPError:
+            now=datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)-datetime.timedelta(days=1)
+        if cached is None:
+            debug("Getting the list of groups at server...")
+            resp,glist=server.list()
+            cached={"groups":{}}
+        else:
+            resp,glist=server.newgroups(cached["fetched"])
+            debug("New groups at server since",cached["fetched"],":",len(glist),level=2)
+        for g in glist:
+            cached["groups"][g.group]=(int(g.first),int(g.last))
+        cached["fetched"]=now
+        storage.put(self["server"],cached,"grouplist")
+        matches=groupMatcher(pattern,regex) if pattern else lambda gname:True
+        return {gname:{"first":first,"last":last} for gname,(first,last) in cached["groups"].items() if matches(gname)}
+
+    def getMinMaxTstamp(self,gname=None):
+        """Returns the (earliest, latest) UTC datetime of the emails of group gname, or of the dataset; (None, None) if there are none"""
+        mint,maxt=emailTable.minMaxEpoch(gname)
+        if mint is None:
+            return None,None
+        return epochDatetime(mint),epochDatetime(maxt)
     def summarize(self):
         """Print a summary of this dataset"""
         for x in self:
@@ -149,102 +1037,423 @@ class NNTPDataset(dict):
                 print(self[x]) 
         if "groups" in self:
             print("GROUPS:")
+            counts=emailTable.countByGroup()
+            storage.createtable("groupmissing")
             for gname,g in self["groups"].items():
-                print("  ",gname)
+                missing=sum(b-a+1 for a,b in self.getMissingSpans(gname))
+                mint,maxt=self.getMinMaxTstamp(gname)
+                span=", from %s to %s"%(mint.date(),maxt.date()) if mint else ""
+                print("  ",gname," (collected messages: %d, could not retrieve: %d%s)"%(counts.get(gname,0),missing,span))
                 
     def getServer(self):
         debug("Connecting to NNTP server: %s:%d"%(self["server"],self["port"]))
-        self.server=nntplib.NNTP(self["server"], self["port"], self["username"] , self["password"],1)
-        return self.server
+        return nntplib.NNTP(self["server"], self["port"], self["username"] , self["password"],1) #not kept in self, which is pickled
     
     def getGroupPointer(self,gname):
-        return storage.select(gname,"grouppointers")
+        return storage.get(gname,"grouppointers")
     
     def setGroupPointer(self,gname,pointer):
-        storage.insert(pointer,gname,"grouppointers")
-
-    def incrementGroupPointer(self,gname):
-        self.setGroupPointer(gname,self.getGroupPointer(gname)+1)
-        debug("Downloaded",gname,self.getGroupPointer(gname),progress=True)
-        
-    def hasMoreInGroup(self,gname):
-        if self.getGroupPointer(gname)>self["groups"][gname]["last"]:
-            return False
-        return True
-    
-    def addEmail(self,uniqueID,**kw):
-        storage.insert(kw,uniqueID,"emails")
-        debug("Added ",uniqueID,kw,level=2)
-        
-    def download(self):
-        server=self.getServer()
-        patterns={"date":"NNTP-Posting-Date:","sender":"From:","refs":"References:"}
-        for gname,g in self["groups"].items():
-            server.group(gname)
-            while self.hasMoreInGroup(gname):
-                i=self.getGroupPointer(gname)
-                err=False
+        storage.put(gname,pointer,"grouppointers")
+
+    def makeEmail(self,gname,msgid,sender,tstamp,refs,senderemail=None):
+        """Returns the (uniqueID, fields) of an email as stored in the 'emails' table; senderemail is sender parsed, if known"""
+        uniqueID=gname+"-"+msgid #to prevent msg ID conflicts across mailgroups
+        if senderemail is None:senderemail=parseEmailAddress(sender)
+        return uniqueID,dict(msgid=msgid,gname=gname,senderemail=senderemail,tstamp=tstamp,epoch=tstampEpoch(tstamp),references=refs)
+
+    def fetchHead(self,server,gname,i):
+        """
+        Retrieves article number i of the current group with HEAD. Returns
+        (uniqueID, fields) or None if the article could not be retrieved
+        """
+        try:
+            response, info=server.head(str(i))
+        except nntplib.NNTPTemporaryError as e:
+            debug("NNTP error:",gname,i,e,level=1)
+            return None
+        return self.parseHead(gname,i,info.message_id,info.lines)
+
+    def parseHead(self,gname,i,ID,headerlist):
+        """Returns (uniqueID, fields) of a retrieved article header, or None if it is unusable"""
+        vals=extractHeaders(headerlist)
+        if not "date" in vals and "sent" in vals:
+            vals["date"]=vals["sent"] #not every server adds NNTP-Posting-Date
+        try:
+            uniqueID,kw=self.makeEmail(gname,ID,vals["sender"],vals["date"],vals.get("refs","").split())
+        except KeyError as e:
+            debug("Header missing:",gname,i,e,level=1)
+            return None
+        if "xref" in vals:kw["xref"]=vals["xref"] #see storeEmail
+        return uniqueID,kw
+
+    def fetchHeads(self,server,gname,start,end,writer=None,size=OVERRANGE):
+        """
+        Yields (number, email) for articles start..end, one HEAD command each.
+        Articles the writer has already are skipped. If the writer tracks
+        Message-IDs, those of 'size' articles at a time are looked up first
+        with XHDR, and articles collected in another group are copied from
+        there instead of being retrieved.
+        """
+        for first in range(start,end+1,size):
+            last=min(first+size-1,end)
+            ids=None
+            if writer and writer.msgids:
                 try:
-                    response, number, ID, headerlist=server.head(str(i))
-                    ID=ID.decode("ascii")
-                    uniqueID=gname+"-"+ID #to prevent msg ID conflicts across mailgroups
-                    vals={}
-                    for h in headerlist:
-                        h=h.decode("ascii")
-                        for pk in patterns:
-                            p=patterns[pk]
-                            if h.find(p)==0:vals[pk]=h[len(p):].strip()
-                    refs=vals.get("refs","").split()
-                    senderemail=parseEmailAddress(vals["sender"])
-                    self.addEmail(uniqueID,msgid=ID,gname=gname,senderemail=senderemail,tstamp=vals["date"],references=refs)
-                except nntplib.NNTPTemporaryError as e:
-                    debug("NNTP error:",gname,i,e,level=1)
-                    err=True
-                except UnicodeDecodeError as e:
-                    debug(vals,level=3)
-                    debug("Unicode error:",gname,i,e,level=1)
-                    err=True
-                except KeyboardInterrupt:
-                    debug("INTERRUPTED",level=1)
+                    resp,ids=server.xhdr("Message-ID","%d-%d"%(first,last))
+                    ids={int(i):msgid for i,msgid in ids}
+                except nntplib.NNTPError as e:
+                    debug("NNTP error:",gname,first,last,e,level=2)
+            for i in range(first,last+1):
+                if writer and writer.isDone(gname,i):
+                    continue
+                if ids is not None:
+                    if not i in ids:
+                        yield i,None #not at the server
+                        continue
+                    known=writer.knownEmail(ids[i])
+                    if known:
+                        yield i,(gname+"-"+known["msgid"],dict(known,gname=gname))
+                        continue
+                yield i,self.fetchHead(server,gname,i)
+
+    def fetchOverviews(self,server,gname,start,end,size=OVERRANGE,writer=None):
+        """
+        Yields (number, email) for articles start..end, retrieving the overview
+        database 'size' articles per OVER command. Only articles whose overview
+        lacks a needed field are retrieved with HEAD, as are all articles of a
+        range whose OVER command fails, e.g. on servers without OVER. Numbers
+        missing from an overview are articles the server does not have, and
+        yield None. Note that overviews carry the Date header, whereas HEAD
+        uses NNTP-Posting-Date, or Date where it is missing. Articles the
+        writer has already are skipped.
+        """
+        for first in range(start,end+1,size):
+            last=min(first+size-1,end)
+            try:
+                resp,overviews=server.over((first,last))
+            except (nntplib.NNTPTemporaryError,nntplib.NNTPPermanentError) as e:
+                debug("NNTP error, using HEAD:",gname,first,last,e,level=2)
+                for i in range(first,last+1):
+                    if not (writer and writer.isDone(gname,i)):
+                        yield i,self.fetchHead(server,gname,i)
+                continue
+            found={i:extractOverview(ov) for i,ov in overviews}
+            senders=parseEmailAddresses(ov.get("from","") for ov in found.values())
+            for i in range(first,last+1):
+                if writer and writer.isDone(gname,i):
+                    continue
+                if not i in found:
+                    yield i,None
+                    continue
+                email=self.parseOverview(gname,found[i],senders)
+                if email:
+                    yield i,email
+                else:
+                    debug("Incomplete overview, using HEAD:",gname,i,level=2)
+                    yield i,self.fetchHead(server,gname,i)
+
+    def parseOverview(self,gname,ov,senders={}):
+        """Returns (uniqueID, fields) of an overview as by extractOverview, or None if it lacks a needed field; senders as by parseEmailAddresses"""
+        if ov.get("message-id") and ov.get("from") and ov.get("date"):
+            uniqueID,kw=self.makeEmail(gname,ov["message-id"],ov["from"],ov["date"],ov.get("references","").split(),senders.get(ov["from"]))
+            if ov.get("xref"):kw["xref"]=ov["xref"] #see storeEmail
+            return uniqueID,kw
+        return None
+
+    async def fetchHeadAsync(self,client,gname,i):
+        """Like fetchHead, over an AsyncNNTP client; returns (number, email)"""
+        try:
+            response, info=await client.head(i)
+        except nntplib.NNTPTemporaryError as e:
+            debug("NNTP error:",gname,i,e,level=1)
+            return i,None
+        return i,self.parseHead(gname,i,info.message_id,info.lines)
+
+    async def fetchHeadsAsync(self,client,gname,first,last,writer):
+        """Like fetchHeads with Message-ID lookups, for articles first..last over an AsyncNNTP client; returns [(number, email)]"""
+        try:
+            resp,ids=await client.xhdr("Message-ID",(first,last))
+            ids=dict(ids)
+        except (nntplib.NNTPTemporaryError,nntplib.NNTPPermanentError) as e:
+            debug("NNTP error:",gname,first,last,e,level=2)
+            ids=None
+        fetched=[]
+        heads=[]
+        for i in range(first,last+1):
+            if writer.isDone(gname,i):
+                continue
+            if ids is not None and not i in ids:
+                fetched.append((i,None))
+                continue
+            known=writer.knownEmail(ids[i]) if ids else None
+            if known:
+                fetched.append((i,(gname+"-"+known["msgid"],dict(known,gname=gname))))
+            else:
+                heads.append(i)
+        fetched.extend(await asyncio.gather(*(self.fetchHeadAsync(client,gname,i) for i in heads)))
+        return sorted(fetched,key=lambda f:f[0])
+
+    async def fetchOverviewAsync(self,client,gname,first,last,writer=None):
+        """Like fetchOverviews for articles first..last, over an AsyncNNTP client; returns [(number, email)]"""
+        try:
+            resp,overviews=await client.over((first,last))
+        except (nntplib.NNTPTemporaryError,nntplib.NNTPPermanentError) as e:
+            debug("NNTP error, using HEAD:",gname,first,last,e,level=2)
+            heads=[i for i in range(first,last+1) if not (writer and writer.isDone(gname,i))]
+            return await asyncio.gather(*(self.fetchHeadAsync(client,gname,i) for i in heads))
+        found={i:extractOverview(ov) for i,ov in overviews}
+        senders=parseEmailAddresses(ov.get("from","") for ov in found.values())
+        fetched={}
+        for i in range(first,last+1):
+            if writer and writer.isDone(gname,i):
+                continue
+            fetched[i]=self.parseOverview(gname,found[i],senders) if i in found else None
+        incomplete=[i for i in found if i in fetched and fetched[i] is None]
+        if incomplete:
+            debug("Incomplete overviews, using HEAD:",gname,incomplete,level=2)
+            fetched.update(await asyncio.gather(*(self.fetchHeadAsync(client,gname,i) for i in incomplete)))
+        return list(fetched.items())
+
+    def getPendingSpans(self,gname):
+        """Returns the (first, last) spans of group gname which remain to be collected"""
+        done=RangeSet(storage.get(gname,"groupspans") or [])
+        g=self["groups"][gname]
+        return done.missing(max(self.getGroupPointer(gname),g["first"]),g["last"]) #articles below 'first' have expired
+
+    def getMissingSpans(self,gname):
+        """Returns the (first, last) spans of group gname which could not be retrieved"""
+        first=self["groups"][gname]["first"]
+        return [(max(a,first),b) for a,b in storage.get(gname,"groupmissing") or [] if b>=first] #articles below 'first' have expired
+
+    def getPendingTasks(self,shards=1,missing=False):
+        """
+        Returns (gname, spans) to collect for all selected groups, splitting
+        each in 'shards'. These are the articles not yet collected or, if
+        'missing' is set, those which could not be retrieved
+        """
+        for table in ["groupspans","groupmissing"]:
+            storage.createtable(table) #datasets set up by older versions lack these
+        tasks=[]
+        for gname in self["groups"]:
+            spans=self.getMissingSpans(gname) if missing else self.getPendingSpans(gname)
+            if shards>1:
+                tasks.extend((gname,shard) for shard in splitSpans(spans,shards))
+            elif spans:
+                tasks.append((gname,spans))
+        return tasks
+
+    def storeEmail(self,writer,gname,i,email):
+        """
+        Hands article i of group gname over to writer: the email, or None if
+        it could not be retrieved. Copies of a cross-posted email are handed
+        over at once for the other selected groups its Xref names, so that
+        they are not retrieved again there.
+        """
+        if email:
+            uniqueID,kw=email
+            for g,n in parseXref(kw.pop("xref","")):
+                if g!=gname and g in self["groups"] and not writer.isDone(g,n):
+                    writer.addEmail(g+"-"+kw["msgid"],**dict(kw,gname=g))
+                    writer.markDone(g,n)
+            writer.addEmail(uniqueID,**kw)
+        writer.markDone(gname,i,email is not None)
+
+    def collectSpans(self,server,gname,spans,writer,stop,overview=False,overrange=OVERRANGE,controller=None):
+        """
+        Collect headers of the given spans of group gname over the given
+        server connection, until done or 'stop' is set
+        """
+        server.group(gname)
+        for first,last in spans:
+            if overview:
+                fetched=self.fetchOverviews(server,gname,first,last,overrange,writer)
+            else:
+                fetched=self.fetchHeads(server,gname,first,last,writer,overrange)
+            for i,email in fetched:
+                self.storeEmail(writer,gname,i,email)
+                debug("Downloaded",gname,i,controller.status() if controller else "",progress=True)
+                if stop.is_set():
                     return
-                self.incrementGroupPointer(gname)
+
+    def download(self,batchsize=BATCHSIZE,interval=BATCHINTERVAL,overview=False,overrange=OVERRANGE,workers=1,maxconnections=MAXCONNECTIONS,shards=1,missing=False,maxrate=MAXRATE,msgids=False):
+        """
+        Collect headers of all selected groups, from where we left off,
+        with HEAD per article or, if 'overview' is set, with OVER per
+        'overrange' articles. Emails are committed in batches together
+        with the group pointers, see BatchWriter.
+        With more than one worker, groups are collected concurrently, each
+        over its own connection, using at most 'maxconnections' at a time.
+        With more than one shard, the remaining articles of each group are
+        split into that many shards, each collected over its own connection.
+        If 'missing' is set, only articles which could not be retrieved
+        before are collected again.
+        Requests are paced by a RateController, which sends no more than
+        'maxrate' per second if set.
+        Articles cross-posted to several selected groups are retrieved once,
+        by their Xref headers. If 'msgids' is set, Message-IDs are looked up
+        before retrieving headers, to skip those collected in other groups
+        also when the server does not provide Xref.
+        """
+        writer=BatchWriter(batchsize,interval,msgids)
+        threads=1 if workers<=1 and shards<=1 else min(max(workers,shards),maxconnections)
+        controller=RateController(threads,maxrate)
+        limit=ConnectionLimit(self,maxconnections,controller)
+        stop=threading.Event()
+        tasks=self.getPendingTasks(shards,missing)
+        def collect(gname,spans):
+            if stop.is_set():
+                return #interrupted before this task started
+            with limit.connection() as server:
+                self.collectSpans(server,gname,spans,writer,stop,overview,overrange,controller)
+        try:
+            if threads==1:
+                with limit.connection() as server:
+                    for gname,spans in tasks:
+                        self.collectSpans(server,gname,spans,writer,stop,overview,overrange,controller)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                    futures={pool.submit(collect,gname,spans):gname for gname,spans in tasks}
+                    try:
+                        for f in concurrent.futures.as_completed(futures):
+                            if f.exception():
+                                debug("Failed collecting",futures[f],":",f.exception(),level=1)
+                    except KeyboardInterrupt:
+                        stop.set()
+                        pool.shutdown(wait=True,cancel_futures=True)
+                        raise
+        except KeyboardInterrupt:
+            debug("INTERRUPTED",level=1)
+        finally:
+            writer.flush()
+
+    def refreshGroups(self,server):
+        """
+        Updates the first and last article numbers of the selected groups,
+        with one GROUP command each. Returns the number of new articles
+        """
+        new=0
+        for gname,g in self["groups"].items():
+            try:
+                resp,count,first,last,name=server.group(gname)
+            except nntplib.NNTPTemporaryError as e:
+                debug("NNTP error:",gname,e,level=1)
+                continue
+            if last>g["last"]:
+                new+=last-g["last"]
+                g["last"]=last
+            if first>g["first"]:
+                g["first"]=first
+                if self.getGroupPointer(gname)<first:
+                    self.setGroupPointer(gname,first) #articles below have expired
+        self.persist()
+        return new
+
+    def sync(self,pipelining=False,window=PIPELINEWINDOW,**kw):
+        """
+        Catches up with the server: refreshes the article numbers of the
+        selected groups and collects the articles which are new since the
+        last run, with download or, if 'pipelining', downloadAsync. When
+        there is nothing new it costs a single connection, so it can be
+        run from cron every few minutes.
+        """
+        with ConnectionLimit(self,1).connection() as server:
+            new=self.refreshGroups(server)
+        debug("New articles at server:",new,level=2)
+        if not self.getPendingTasks():
+            return
+        if pipelining:
+            self.downloadAsync(window=window,**kw)
+        else:
+            self.download(**kw)
+
+    def retry(self,pipelining=False,window=PIPELINEWINDOW,**kw):
+        """
+        Collects again only the articles which could not be retrieved
+        before, with download or, if 'pipelining', downloadAsync
+        """
+        if pipelining:
+            self.downloadAsync(missing=True,window=window,**kw)
+        else:
+            self.download(missing=True,**kw)
+
+    async def getAsyncServer(self,window=PIPELINEWINDOW,controller=None):
+        debug("Connecting to NNTP server: %s:%d"%(self["server"],self["port"]))
+        return await AsyncNNTP(window,controller).connect(self["server"],self["port"],self["username"],self["password"])
+
+    async def collectSpansAsync(self,client,gname,spans,writer,overview=False,overrange=OVERRANGE,window=PIPELINEWINDOW,controller=None):
+        """Like collectSpans, keeping up to 'window' HEAD or OVER commands in flight"""
+        await client.group(gname)
+        if overview:
+            await client.loadOverviewFormat()
+            fetches=(self.fetchOverviewAsync(client,gname,first,min(first+overrange-1,last),writer)
+                for first,last in spans for first in range(first,last+1,overrange))
+        elif writer.msgids:
+            fetches=(self.fetchHeadsAsync(client,gname,first,min(first+overrange-1,last),writer)
+                for first,last in spans for first in range(first,last+1,overrange))
+        else:
+            fetches=(self.fetchHeadAsync(client,gname,i) for first,last in spans for i in range(first,last+1) if not writer.isDone(gname,i))
+        async for fetched in pipelined(fetches,window):
+            for i,email in (fetched if isinstance(fetched,list) else [fetched]):
+                self.storeEmail(writer,gname,i,email)
+                debug("Downloaded",gname,i,controller.status() if controller else "",progress=True)
+
+    async def collectAsync(self,tasks,writer,overview=False,overrange=OVERRANGE,connections=1,window=PIPELINEWINDOW,maxrate=MAXRATE):
+        slots=asyncio.Semaphore(connections)
+        controller=RateController(connections*window,maxrate)
+        async def collect(gname,spans):
+            async with slots:
+                client=await self.getAsyncServer(window,controller)
+                try:
+                    await self.collectSpansAsync(client,gname,spans,writer,overview,overrange,window,controller)
+                finally:
+                    await client.quit()
+        results=await asyncio.gather(*(collect(gname,spans) for gname,spans in tasks),return_exceptions=True)
+        for (gname,spans),result in zip(tasks,results):
+            if isinstance(result,Exception):
+                debug("Failed collecting",gname,":",result,level=1)
+
+    def downloadAsync(self,batchsize=BATCHSIZE,interval=BATCHINTERVAL,overview=False,overrange=OVERRANGE,workers=1,maxconnections=MAXCONNECTIONS,shards=1,missing=False,maxrate=MAXRATE,msgids=False,window=PIPELINEWINDOW):
+        """
+        Like download, but with the asyncio client: each connection keeps up
+        to 'window' commands in flight instead of waiting for every response,
+        so a single connection gets most of the speedup of several.
+        """
+        writer=BatchWriter(batchsize,interval,msgids)
+        tasks=self.getPendingTasks(shards,missing)
+        try:
+            asyncio.run(self.collectAsync(tasks,writer,overview,overrange,min(max(workers,shards),maxconnections),window,maxrate))
+        except KeyboardInterrupt:
+            debug("INTERRUPTED",level=1)
+        finally:
+            writer.flush()
+
     def dump(self,targetfp):
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
-            gname=info["gname"]
-            msgid=info["msgid"]
-            senderemail=info["senderemail"]
-            tstamp=info["tstamp"]
-            if info["references"]:
-                lastref=info["references"][-1]
+        for gname,msgid,senderemail,tstamp,epoch,lastref,recipient,senderid,recipientid in emailTable.iterReplies():
+            if lastref:
                 print("Searching lastref",lastref)
-                ref=storage.select(gname+"-"+lastref,"emails")
-                if not ref:
+                if recipient is None:
                     print("Reference not found")
                     continue
-                recipient=ref["senderemail"]
-            else:
-                recipient=None
             print(gname, msgid, senderemail, recipient, tstamp)
         #msgid=ID,gname=gname,senderemail=senderemail,tstamp=vals["date"],references=refs
         #targetfp.write("Not implemented yet\n")
     def dumpcco(self,targetfp):
         retval=[]
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
+        for x,(ign,mid,info) in storage.iterdic(table="emails"):
             gname=info["gname"]
             msgid=info["msgid"]
             senderemail=info["senderemail"]
-            tstamp=info["tstamp"]
-            ts=parser.parse(tstamp)
+            epoch=info["epoch"] if "epoch" in info else tstampEpoch(info["tstamp"]) #older projects did not store it
             refs=[]
             if info["references"]:refs=info["references"]
-            m={"id":msgid,"from":senderemail, "timestamp":calendar.timegm(ts.timetuple()), "references":refs}
+            m={"id":msgid,"from":senderemail, "timestamp":epoch, "references":refs}
             retval.append(m)
         targetfp.write(json.dumps(retval))
 
     def DELETEdumpcco(self,targetfp):
         targetfp.write("[\n")
         j=0
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
+        for x,(ign,mid,info) in storage.iterdic(table="emails"):
             if j>0:targetfp.write(",\n")
             gname=info["gname"]
             msgid=info["msgid"]
@@ -264,72 +1473,42 @@ class NNTPDataset(dict):
             j+=1
         targetfp.write("]")
     def ensureDumpBase(self):
-        try:
-            self.actors
+        if getattr(self,"actors",None) is not None:
             return #already done
-        except:
-            debug("Building data for dumping out")
+        debug("Building data for dumping out")
         self.mint,self.maxt=self.getMinMaxTstamp()
-        actors={}
-        c=0
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
-            c+=1
-            debug("Processing actor %d"%c,level=2,progress=True)
-            gname=info["gname"]
-            msgid=info["msgid"]
-            senderemail=info["senderemail"]
-            if not senderemail in actors:actors[senderemail]=[]
-            tstamp=info["tstamp"]
-            actors[senderemail].append(parser.parse(tstamp))
-            if info["references"]:
-                lastref=info["references"][-1]
-                ref=storage.select(gname+"-"+lastref,"emails")
-                if not ref:
-                    debug("Reference not found",level=2)
-                    continue
-                recipient=ref["senderemail"]
-                if not recipient in actors:actors[recipient]=[]
-                actors[recipient].append(parser.parse(tstamp))
-            else:
-                recipient=None
-        actorids={}
-        id=0
-        for i,v in actors.items():
-            actorids[i]=id
-            id+=1        
-        self.actors=actors
-        self.actorids=actorids
+        actors=emailTable.actorEmails()
+        first=[None]*len(actors) #earliest and latest epoch of each actor id
+        last=[None]*len(actors)
         edges=[]
-        id=0
         c=0
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
+        for gname,msgid,senderemail,tstamp,epoch,lastref,recipient,senderid,recipientid in emailTable.iterReplies():
             c+=1
-            debug("Processing relation %d"%c,level=2,progress=True)
-            gname=info["gname"]
-            msgid=info["msgid"]
-            senderemail=info["senderemail"]
-            tstamp=info["tstamp"]
-            pts=parser.parse(tstamp)
-            if info["references"]:
-                lastref=info["references"][-1] #the last reference is the immediate parent of the message reply
-                ref=storage.select(gname+"-"+lastref,"emails")
-                if not ref:
+            debug("Processing email %d"%c,level=2,progress=True)
+            if epoch is None:
+                debug("Timestamp not understood:",tstamp,level=2)
+                continue
+            if senderid is None or senderid>=len(actors) or (recipientid or 0)>=len(actors):
+                debug("Actor id not found",level=2) #collected since the export started
+                continue
+            ids=(senderid,recipientid) if lastref and recipientid is not None else (senderid,)
+            for id in ids:
+                if first[id] is None or epoch<first[id]:first[id]=epoch
+                if last[id] is None or epoch>last[id]:last[id]=epoch
+            if lastref: #the last reference is the immediate parent of the message reply
+                if recipientid is None:
                     debug("Reference not found",level=2)
                     continue
-                recipient=ref["senderemail"]
-                if senderemail in actorids and recipient in actorids:
-                    edge=(id,actorids[senderemail],actorids[recipient],formatTstamp(pts))
-                    edges.append(edge)
-                    id+=1
-                else:
-                    debug("Actor id not found",level=2)
-            else:
-                recipient=None
+                edges.append((len(edges),senderid,recipientid,epochDatetime(epoch)))
+        self.actors=actors
+        self.firstepochs=first
+        self.lastepochs=last
         self.edges=edges
     def nodesIterator(self):
         """Yields (id, email, minTime, maxTime) for each actor"""
-        for email,id in self.actorids.items():
-            yield (id,email,min(self.actors[email]),max(self.actors[email]))
+        for id,email in enumerate(self.actors):
+            if self.firstepochs[id] is not None:
+                yield (id,email,epochDatetime(self.firstepochs[id]),epochDatetime(self.lastepochs[id]))
     def edgesIterator(self):
         for e in self.edges:
             yield e
@@ -348,12 +1527,12 @@ class NNTPDataset(dict):
         tb.start("graph",{"mode":"dynamic","start":formatTstamp(self.mint),"end":formatTstamp(self.maxt)})
         tb.start("nodes",{})
         for id,email,mint,maxt in self.nodesIterator():
-            tb.start("node",{"id":id,"label":email,"start":formatTstamp(mint),"end":formatTstamp(maxt)})
+            tb.start("node",{"id":str(id),"label":email,"start":formatTstamp(mint),"end":formatTstamp(maxt)})
             tb.end("node")
         tb.end("nodes")
         tb.start("edges",{})
         for id,sender,rec,tstamp in self.edgesIterator():
-            tb.start("edge",{"id":id, "source":sender,"target":rec,"start":formatTstamp(tstamp),"end":formatTstamp(tstamp)})
+            tb.start("edge",{"id":str(id), "source":str(sender),"target":str(rec),"start":formatTstamp(tstamp),"end":formatTstamp(tstamp)})
             tb.end("edge")
         tb.end("edges")
         tb.end("graph")
@@ -372,7 +1551,7 @@ class NNTPDataset(dict):
  <graph mode="dynamic" start="%s" end="%s">
         """%(projectName,formatTstamp(mint),formatTstamp(maxt)))
         actors={}
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
+        for x,(ign,mid,info) in storage.iterdic(table="emails"):
             gname=info["gname"]
             msgid=info["msgid"]
             senderemail=info["senderemail"]
@@ -381,7 +1560,7 @@ class NNTPDataset(dict):
             actors[senderemail].append(parser.parse(tstamp))
             if info["references"]:
                 lastref=info["references"][-1]
-                ref=storage.select(gname+"-"+lastref,"emails")
+                ref=storage.get(gname+"-"+lastref,"emails")
                 if not ref:
                     debug("Reference not found",level=2)
                     continue
@@ -400,7 +1579,7 @@ class NNTPDataset(dict):
         targetfp.write("  </nodes>\n")
         targetfp.write("  <edges>\n")
         id=0
-        for x,(ign,mid,info) in storage.selectdic("*","emails").items():
+        for x,(ign,mid,info) in storage.iterdic(table="emails"):
             gname=info["gname"]
             msgid=info["msgid"]
             senderemail=info["senderemail"]
@@ -408,7 +1587,7 @@ class NNTPDataset(dict):
             pts=parser.parse(tstamp)
             if info["references"]:
                 lastref=info["references"][-1]
-                ref=storage.select(gname+"-"+lastref,"emails")
+                ref=storage.get(gname+"-"+lastref,"emails")
                 if not ref:
                     debug("Reference not found",level=2)
                     continue
@@ -422,80 +1601,60 @@ class NNTPDataset(dict):
  </graph>
 </gexf>        
         """)
-    def resetActors(self):
-        storage.insert({},"_","actors")
-        storage.delete("*","actors")
-        self.actorid=0
-    def ensureActor(self,email):
-        if not storage.select(email,"actors"):
-            self.actorid+=1
-            #print("Adding actor:",email)
-            storage.insert({"email":email,"iid":self.actorid},email,"actors")
     def getActorId(self,email):
-        a=storage.select(email,"actors")
-        return a["iid"]
+        return emailTable.actorIds([email])[0]
     def getActId(self,msgid):
         #debug("Seeking act for msgid:"+msgid)
-        a=storage.select(msgid,"acts")
+        a=storage.get(msgid,"acts")
         return a["iid"]
     def resetRelations(self):
         storage.insert({},"_","relations")
         storage.delete("*","relations")
         self.relationid=0
-    def ensureEmail(self,msgid,sender=None,recipient=None,tstampstr=None):
-        if not storage.select(msgid,"relations"):
+    def ensureEmail(self,msgid,sender=None,recipient=None,tstampstr=None,epoch=None,senderid=None,recipientid=None):
+        if not storage.get(msgid,"relations"):
             self.relationid+=1
-            storage.insert({"iid":self.relationid,"sender":sender,"recipient":recipient,"tstampstr":tstampstr},msgid,"relations")
+            storage.put(msgid,{"iid":self.relationid,"sender":sender,"recipient":recipient,"tstampstr":tstampstr,"epoch":epoch,"senderid":senderid,"recipientid":recipientid},"relations")
     def resetActs(self):
         storage.insert({},"_","acts")
         storage.delete("*","acts")
         self.actid=0
-    def ensureAct(self,msgid,sender=None,reference=None,tstampstr=None,type=None):
-        if not storage.select(msgid,"acts"):
+    def ensureAct(self,msgid,sender=None,reference=None,tstampstr=None,type=None,epoch=None,senderid=None):
+        if not storage.get(msgid,"acts"):
             self.actid+=1
             #debug("Ensuring act (%d) for reference:"%self.actid+str(reference)+", and msgid:"+str(msgid))
-            storage.insert({"iid":self.actid,"sender":sender,"reference":reference,"tstampstr":tstampstr,"type":type},msgid,"acts")
+            storage.put(msgid,{"iid":self.actid,"sender":sender,"reference":reference,"tstampstr":tstampstr,"type":type,"epoch":epoch,"senderid":senderid},"acts")
     def dumpGeneric(self,reset=False,output=True):
+        """Builds the relations and acts tables, unless they are there and not 'reset'; actors are those of emailTable"""
         try:
-            actors=storage.select("*","actors")
+            acts=storage.select("*","acts")
         except:
-            actors=[]
-        if actors is None or reset:
-            debug("Building actor list")
-            self.resetActors()
+            acts=None
+        if acts is None or reset:
+            debug("Building relation list")
             self.resetRelations()
             self.resetActs()
             c=0
             errs=0
-            for uid, (ign,mid,info) in storage.selectdic("*","emails").items():
+            for gname,msgid,senderemail,tstamp,epoch,lastref,recipient,senderid,recipientid in emailTable.iterReplies():
                 c+=1
                 debug("Processing email %d"%c,level=2,progress=True)
-                gname=info["gname"]
-                msgid=info["msgid"]
-                senderemail=info["senderemail"]
-                tstamp=info["tstamp"]
-                #pts=parser.parse(tstamp)
-                self.ensureActor(senderemail)
-                if info["references"]:
-                    lastref=info["references"][-1]
-                    ref=storage.select(gname+"-"+lastref,"emails")
-                    if not ref:
+                if lastref:
+                    if recipient is None:
                         debug("Reference not found",level=2)
                         errs+=1
                         #TODO: Following is not really correct!
                         debug("PHONY 'CALL' ACT (insertin call instead of a reply since reply reference is not found)!")
-                        self.ensureAct(msgid,sender=senderemail,tstampstr=tstamp,type="call")
+                        self.ensureAct(msgid,sender=senderemail,tstampstr=tstamp,type="call",epoch=epoch,senderid=senderid)
                     else:
-                        recipient=ref["senderemail"]
-                        self.ensureActor(recipient)
-                        self.ensureEmail(msgid,sender=senderemail,recipient=recipient,tstampstr=tstamp)
-                        self.ensureAct(msgid,sender=senderemail,reference=lastref,tstampstr=tstamp,type="reply")
+                        self.ensureEmail(msgid,sender=senderemail,recipient=recipient,tstampstr=tstamp,epoch=epoch,senderid=senderid,recipientid=recipientid)
+                        self.ensureAct(msgid,sender=senderemail,reference=lastref,tstampstr=tstamp,type="reply",epoch=epoch,senderid=senderid)
                 else:
-                    self.ensureAct(msgid,sender=senderemail,tstampstr=tstamp,type="call")
+                    self.ensureAct(msgid,sender=senderemail,tstampstr=tstamp,type="call",epoch=epoch,senderid=senderid)
+            print("Number of reference errors: %d"%errs)
         if output:
-            for i,(x,y,a) in storage.selectdic("*","actors").items():
-                print("actor:",a["iid"])
-        print("Number of reference errors: %d"%errs)
+            for id,email in enumerate(emailTable.actorEmails()):
+                if email is not None:print("actor:",id)
     def dumpFan(self,targetfp,projectName="noname",reset=False):
         if not reset:
             debug("Starting dump without reset")
@@ -508,17 +1667,18 @@ Network {
     meta=["creator":"Lavi","description":"A simple static network"]
     actors=[
         """%projectName)
-        for i,(x,y,a) in storage.selectdic("*","actors").items():
-            targetfp.write("""Actor{id=%d; name="%s"},\n"""%(a["iid"],a["email"].replace('"','')))
+        for id,email in enumerate(emailTable.actorEmails()):
+            if email is not None:targetfp.write("""Actor{id=%d; name="%s"},\n"""%(id,email.replace('"','')))
         targetfp.write("""
         ]
         relations=[
         """)
-        for i,(x,y,r) in storage.selectdic("*","relations").items():
+        for i,(x,y,r) in storage.iterdic(table="relations"):
             #print("RELATION:",r)
-            pts=parser.parse(r["tstampstr"])
-            srca=self.getActorId(r["sender"])
-            targetfp.write("""Relation{actors=[%d,%d];src=%d;startTstamp=DateTime("%s Istanbul")},\n"""%(srca,self.getActorId(r["recipient"]),srca,pts.isoformat()))
+            pts=epochDatetime(r.get("epoch") or tstampEpoch(r["tstampstr"])) #relations built by older versions lack the epoch
+            srca=r.get("senderid") or self.getActorId(r["sender"]) #relations built by older versions lack the ids
+            reca=r.get("recipientid") or self.getActorId(r["recipient"])
+            targetfp.write("""Relation{actors=[%d,%d];src=%d;startTstamp=DateTime("%s Istanbul")},\n"""%(srca,reca,srca,pts.isoformat()))
             #targetfp.write("""Relation{actors=[%d,%d],start=%df},\n"""%(self.getActorId(r["sender"]),self.getActorId(r["recipient"]),time.mktime(pts.timetuple())))
         targetfp.write("""
         ]
@@ -535,20 +1695,20 @@ Network {
 </meta>  
 <actors>
         """%projectName)
-        for i,(x,y,a) in storage.selectdic("*","actors").items():
-            targetfp.write("""<actor id='%d' name="%s"/>\n"""%(a["iid"],a["email"].replace('"','')))
+        for id,email in enumerate(emailTable.actorEmails()):
+            if email is not None:targetfp.write("""<actor id='%d' name="%s"/>\n"""%(id,email.replace('"','')))
         targetfp.write("""
 </actors>
 <actions>
         """)
-        for i,(x,y,r) in storage.selectdic("*","acts").items():
+        for i,(x,y,r) in storage.iterdic(table="acts"):
             #print("RELATION:",r)
-            pts=parser.parse(r["tstampstr"])
-            srca=self.getActorId(r["sender"])
+            epoch=r.get("epoch") or tstampEpoch(r["tstampstr"]) #acts built by older versions lack the epoch and ids
+            srca=r.get("senderid") or self.getActorId(r["sender"])
             if r["type"]=="call":
-                targetfp.write("""<act type='%s' id='%d' src='%d' time='%d'/>\n"""%(r["type"],r["iid"],srca,time.mktime(pts.timetuple())))
+                targetfp.write("""<act type='%s' id='%d' src='%d' time='%d'/>\n"""%(r["type"],r["iid"],srca,epoch))
             else:
-                targetfp.write("""<act type='%s' id='%d' src='%d' reference='%d' time='%d'/>\n"""%(r["type"],r["iid"],srca,self.getActId(r["reference"]),time.mktime(pts.timetuple())))
+                targetfp.write("""<act type='%s' id='%d' src='%d' reference='%d' time='%d'/>\n"""%(r["type"],r["iid"],srca,self.getActId(r["reference"]),epoch))
             #targetfp.write("""Relation{actors=[%d,%d],start=%df},\n"""%(self.getActorId(r["sender"]),self.getActorId(r["recipient"]),time.mktime(pts.timetuple())))
         targetfp.write("""
 </actions>
@@ -560,21 +1720,31 @@ def printHelp():
     debug("")
     debug(" Options:")
     debug("   -v: verbose mode, print debug messages (can use multiple times)")
+    debug("   -p profile: database performance profile, one of %s (default: %s)"%(", ".join(sorted(yserial.Base.PROFILES)),PROFILE))
     debug(" Commands:")
     debug("   summarize : this is the default command, summarizes options")
-    debug("   setup : asks questions to initialize what to collect and from where")
-    debug("   collect : start or continue collecting data from where left")
+    debug("   setup [--groups pattern] [--regex] [--refresh] [--server host] [--port port] [--username name] [--password password]: asks questions to initialize what to collect and from where. With --groups nothing is asked: all groups matching the pattern are selected, e.g. 'gmane.comp.python.*,!*.devel', or a regular expression with --regex. The server's group list is cached; --refresh downloads it anew")
+    debug("   collect [-n count] [-t seconds] [-o] [-r range] [-w workers] [-c connections] [-s shards] [-l rate] [-m] [-a] [-i window]: start or continue collecting data from where left. Commits every 'count' emails (default %d) or 'seconds' (default %g). -o uses the server's overview database, 'range' articles per request (default %d), instead of one request per article. -w collects that many groups concurrently, using at most 'connections' (default %d) connections. -s splits each group into that many shards, collected concurrently. -l sends at most 'rate' requests per second; concurrency also backs off by itself when the server slows down or fails requests. Articles cross-posted to several selected groups are retrieved once, by their Xref headers; -m also looks up Message-IDs first, for servers without Xref. -a pipelines requests over asyncio connections, keeping 'window' (default %d) requests in flight on each"%(BATCHSIZE,BATCHINTERVAL,OVERRANGE,MAXCONNECTIONS,PIPELINEWINDOW))
+    debug("   sync [collect options]: ask the server for new articles in the selected groups and collect only those. Cheap when there is nothing new, e.g. for running from cron; a sync still running makes another one of the same project exit")
+    debug("   retry [collect options]: collect again only the articles which could not be retrieved before")
     debug("   delete : remove this project from workspace")
+    debug("   compact : shrink a project created by an older version, keeping only the latest row per key")
     #debug("   dump <target>: dump collected data out. Target is a filename, or - for stdout.")
     #debug("   dumpcco <target>: dump collected data out in cco format. Target is a filename, or - for stdout.")
     debug("   dumpGEXF <target>: dump collected data out in Gephi GEXF format. Target is a filename, or - for stdout.")    
     debug("   dumpfan [-r] <target>: dump collected data out in Fantom language serialization format. Target is a filename, or - for stdout. -r prevents resetting of data processing")    
     debug("   dumplax [-r] <target>: dump collected data out in Lavi XML format serialization format. Target is a filename, or - for stdout. -r prevents resetting of data processing")    
 if __name__=="__main__":
-    opts, args = getopt.getopt(sys.argv[1:], "v", [])
+    opts, args = getopt.getopt(sys.argv[1:], "vp:", [])
     for o, a in opts:
         if o == "-v":
             DEBUG += 1
+        elif o == "-p":
+            PROFILE = a
+    if PROFILE not in yserial.Base.PROFILES:
+        print("Unknown profile:",PROFILE)
+        printHelp()
+        sys.exit(0)
     if args:
         projectName=args.pop(0)
     else:
@@ -589,7 +1759,10 @@ if __name__=="__main__":
 
     if not os.path.exists(PERSISTENCE):
         os.mkdir(PERSISTENCE)
-    storage = yserial.Main("/".join([PERSISTENCE,projectName+".sqlite"]))
+    storage = yserial.Main("/".join([PERSISTENCE,projectName+".sqlite"]),profile=PROFILE)
+    storage.open() #keep connections alive for the whole run instead of one per call
+    configureCodecs()
+    emailTable.ensure()
     try:
         debug("RESTORING DATASET...")
         dataset=NNTPDataset.restore()
@@ -603,13 +1776,69 @@ if __name__=="__main__":
         dataset.summarize()
     elif command=="setup":
         debug("Starting setup of your project...")
-        dataset.setup()
-    elif command=="collect":
-        dataset.download()
+        pattern,regex,refresh,settings=None,False,False,{}
+        opts, args = getopt.getopt(opts, "", ["groups=","regex","refresh","server=","port=","username=","password="])
+        for o, a in opts:
+            if o == "--groups":
+                pattern = a
+            elif o == "--regex":
+                regex = True
+            elif o == "--refresh":
+                refresh = True
+            else:
+                settings[o[2:]] = a
+        dataset.setup(pattern,regex,refresh,settings)
+    elif command in ["collect","sync","retry"]:
+        kw=dict(batchsize=BATCHSIZE,interval=BATCHINTERVAL,overview=False,overrange=OVERRANGE,workers=1,maxconnections=MAXCONNECTIONS,shards=1,maxrate=MAXRATE)
+        pipelining,window=False,PIPELINEWINDOW
+        opts, args = getopt.getopt(opts, "n:t:or:w:c:s:l:mai:", [])
+        for o, a in opts:
+            if o == "-n":
+                kw["batchsize"] = int(a)
+            elif o == "-t":
+                kw["interval"] = float(a)
+            elif o == "-o":
+                kw["overview"] = True
+            elif o == "-r":
+                kw["overrange"] = int(a)
+            elif o == "-w":
+                kw["workers"] = int(a)
+            elif o == "-c":
+                kw["maxconnections"] = int(a)
+            elif o == "-s":
+                kw["shards"] = int(a)
+            elif o == "-l":
+                kw["maxrate"] = float(a)
+            elif o == "-m":
+                kw["msgids"] = True
+            elif o == "-a":
+                pipelining = True
+            elif o == "-i":
+                window = int(a)
+        if command=="sync":
+            import fcntl
+            lock=open("/".join([PERSISTENCE,projectName+".lock"]),"w")
+            try:
+                fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError:
+                debug("Another sync of this project is still running")
+                sys.exit(0)
+            dataset.sync(pipelining=pipelining,window=window,**kw)
+        elif command=="retry":
+            dataset.retry(pipelining=pipelining,window=window,**kw)
+        elif pipelining:
+            dataset.downloadAsync(window=window,**kw)
+        else:
+            dataset.download(**kw)
+    elif command=="compact":
+        dataset.compact()
     elif command=="delete":
         tmp=input("Are you sure? (yes or no):")
         if tmp.lower()=="yes":
-            os.remove("/".join([PERSISTENCE,projectName+".sqlite"]))
+            storage.close()
+            dbfile="/".join([PERSISTENCE,projectName+".sqlite"])
+            for f in [dbfile,dbfile+"-wal",dbfile+"-shm","/".join([PERSISTENCE,projectName+".lock"])]:
+                if os.path.exists(f):os.remove(f)
     elif command=="dump":
         if not opts:
             print("Supply a target filename")
@@ -651,4 +1880,5 @@ if __name__=="__main__":
             dataset.dumpLax(fp,reset=reset,projectName=projectName)
     else:
         print("UNKNOWN COMMAND :",command)
+    storage.close()
         
\ No newline at end of file
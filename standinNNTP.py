@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+"""
+A stand-in news (NNTP) server for testing and benchmarking the collector
+offline. It serves a corpus of article headers, either generated or recorded
+from a real server, and can imitate a distant or unreliable server by
+delaying its responses and failing commands or connections on purpose.
+"""
+import sys, getopt, os, json, random, time, calendar, email.utils, asyncio, threading, nntplib
+
+DEBUG=1
+PORT=1119
+LATENCY=0.0 #seconds each response is delayed by, like a network round trip
+SERVICE=0.0 #seconds the server spends on each command, one command at a time per connection
+OVERFMT=["Subject:","From:","Date:","Message-ID:","References:",":bytes",":lines","Xref:full"]
+
+def debug(*args,level=1):
+    """Print all args to stderr, if level is less than or equal to global DEBUG level"""
+    if level<=DEBUG:
+        sys.stderr.write(" ".join(str(a) for a in args)+"\n")
+
+def syntheticCorpus(groups=2,articles=1000,seed=1,crosspost=0.1,missing=0.01):
+    """
+    Generates a corpus of about 'articles' headers in each of 'groups' groups,
+    with threads of replies, a fraction 'crosspost' of articles posted to two
+    groups, and a fraction 'missing' of article numbers left out. Senders
+    come in the forms seen in practice, including RFC 2047 encoded names.
+    """
+    rnd=random.Random(seed)
+    gnames=["standin.group%d"%g for g in range(groups)]
+    senders=[]
+    for p in range(max(10,articles//20)):
+        form=p%4
+        if form==0:senders.append("User %d <user%d@example.org>"%(p,p))
+        elif form==1:senders.append("user%d@example.net (User %d)"%(p,p))
+        elif form==2:senders.append("\"Last%d, First\" <first.last%d@example.com>"%(p,p))
+        else:senders.append("=?utf-8?q?J=C3=BCrgen_M=C3=BCller_{0}?= <jm{0}@example.de>".format(p))
+    corpus={}
+    numbers={gname:0 for gname in gnames}
+    posted={gname:[] for gname in gnames} #(msgid, refs) of the articles in each group
+    epoch=calendar.timegm((2010,1,1,0,0,0))
+    for k in range(groups*articles):
+        gname=rnd.choice(gnames)
+        targets=[gname]
+        if groups>1 and rnd.random()<crosspost:
+            targets.append(rnd.choice([g for g in gnames if g!=gname]))
+        msgid="<%d.%d@standin.invalid>"%(k,seed)
+        refs=[]
+        if posted[gname] and rnd.random()<0.6:
+            parentid,parentrefs=rnd.choice(posted[gname][-50:])
+            refs=(parentrefs+[parentid])[-5:]
+        epoch+=rnd.randint(1,1200)
+        date=email.utils.formatdate(epoch)
+        xref=[]
+        for g in targets:
+            numbers[g]+=1
+            if rnd.random()<missing:numbers[g]+=1 #a number the server does not have
+            xref.append("%s:%d"%(g,numbers[g]))
+            posted[g].append((msgid,refs))
+        lines=["Path: standin!not-for-mail",
+            "From: "+rnd.choice(senders),
+            "Newsgroups: "+",".join(targets),
+            "Subject: Message %d"%k,
+            "Date: "+date,
+            "Message-ID: "+msgid,
+            "NNTP-Posting-Date: "+date]
+        if refs:lines.append("References: "+" ".join(refs))
+        lines.append("Xref: standin "+" ".join(xref))
+        for g,number in zip(targets,xref):
+            corpus.setdefault(g,{})[int(number.split(":")[1])]=lines
+    return {gname:{"first":1,"last":numbers[gname],"articles":corpus.get(gname,{})} for gname in gnames}
+
+def loadCorpus(fname):
+    """Reads a corpus written by saveCorpus"""
+    with open(fname) as f:
+        corpus=json.load(f)
+    for g in corpus.values():
+        g["articles"]={int(i):lines for i,lines in g["articles"].items()}
+    return corpus
+
+def saveCorpus(corpus,fname):
+    """Writes a corpus as JSON; header lines are kept as latin-1 decoded bytes"""
+    with open(fname,"w") as f:
+        json.dump(corpus,f)
+
+def recordCorpus(host,port,username,password,gname,first=None,count=1000,corpus=None):
+    """
+    Records the headers of 'count' articles of group gname at a real server,
+    from article 'first' on (default: the newest ones), into corpus
+    """
+    corpus=corpus if corpus is not None else {}
+    server=nntplib.NNTP(host,port,username or None,password or None,True)
+    try:
+        resp,n,gfirst,glast,name=server.group(gname)
+        if first is None:first=max(gfirst,glast-count+1)
+        last=min(glast,first+count-1)
+        articles={}
+        for i in range(first,last+1):
+            try:
+                resp,info=server.head(str(i))
+            except nntplib.NNTPTemporaryError as e:
+                continue
+            articles[i]=[line.decode("latin-1") for line in info.lines]
+            debug("Recorded",gname,i,level=2)
+        corpus[gname]={"first":first,"last":last,"articles":articles}
+        return corpus
+    finally:
+        server.quit()
+
+def unfold(lines):
+    """Returns {lowercase name: value} of header lines, joining continuation lines"""
+    fields={}
+    name=None
+    for line in lines:
+        if line[:1] in (" ","\t") and name:
+            fields[name]+=" "+line.strip()
+        elif ":" in line:
+            name,value=line.split(":",1)
+            name=name.lower()
+            fields[name]=value.strip()
+    return fields
+
+class StandinServer:
+    """
+    Serves a corpus ({gname: {"first", "last", "articles": {number: lines}}})
+    over NNTP: CAPABILITIES, MODE READER, AUTHINFO (anything is accepted),
+    DATE, LIST [ACTIVE [wildmat]], LIST OVERVIEW.FMT, LIST HEADERS, NEWGROUPS,
+    GROUP, HEAD, OVER/XOVER, HDR/XHDR and QUIT.
+    Responses are delayed by 'latency' seconds without holding up later
+    commands, as over a network; each command takes 'service' seconds.
+    A fraction 'errors' of HEAD, OVER and HDR commands fail with 403, and a
+    fraction 'drops' of them close the connection instead.
+    """
+    def __init__(self,corpus,latency=LATENCY,service=SERVICE,errors=0.0,drops=0.0,seed=None):
+        self.corpus=corpus
+        self.latency=latency
+        self.service=service
+        self.errors=errors
+        self.drops=drops
+        self.random=random.Random(seed)
+        self.fields={} #(gname, number) -> unfolded header fields, made when first needed
+        self.commands=0
+        self.port=None
+
+    def getFields(self,gname,i):
+        key=(gname,i)
+        if not key in self.fields:
+            self.fields[key]=unfold(self.corpus[gname]["articles"][i])
+        return self.fields[key]
+
+    def overview(self,gname,i):
+        lines=self.corpus[gname]["articles"][i]
+        f=self.getFields(gname,i)
+        size=sum(len(line)+2 for line in lines)
+        values=[f.get("subject",""),f.get("from",""),f.get("date",""),f.get("message-id",""),f.get("references",""),
+            str(size),"0","Xref: "+f["xref"] if "xref" in f else ""]
+        return "\t".join([str(i)]+[v.replace("\t"," ") for v in values])
+
+    def articleRange(self,gname,spec):
+        """Numbers of existing articles in gname given by 'n', 'n-' or 'n-m'"""
+        g=self.corpus[gname]
+        if "-" in spec:
+            a,b=spec.split("-",1)
+            first,last=int(a),int(b) if b else g["last"]
+        else:
+            first=last=int(spec)
+        return [i for i in range(first,last+1) if i in g["articles"]]
+
+    def matches(self,gname,pattern):
+        import fnmatch
+        found=False
+        for w in pattern.split(","):
+            if fnmatch.fnmatchcase(gname,w.lstrip("!")):found=not w.startswith("!")
+        return found
+
+    def respond(self,state,words):
+        """Returns the response lines for a command, or None to drop the connection"""
+        c=words[0].upper()
+        args=words[1:]
+        if c in ["HEAD","OVER","XOVER","HDR","XHDR"]:
+            if self.random.random()<self.drops:return None
+            if self.random.random()<self.errors:return ["403 Injected fault"]
+        if c=="CAPABILITIES":
+            return ["101 Capability list:","VERSION 2","READER","OVER","HDR","LIST ACTIVE NEWSGROUPS OVERVIEW.FMT HEADERS","."]
+        if c=="MODE":
+            return ["200 Reader mode, posting prohibited"]
+        if c=="AUTHINFO":
+            return ["381 Password required"] if args and args[0].upper()=="USER" else ["281 Authentication accepted"]
+        if c=="DATE":
+            return ["111 "+time.strftime("%Y%m%d%H%M%S",time.gmtime())]
+        if c=="QUIT":
+            return ["205 Bye"]
+        if c=="LIST":
+            kind=args[0].upper() if args else "ACTIVE"
+            if kind=="ACTIVE":
+                pattern=args[1] if len(args)>1 else "*"
+                return ["215 List of newsgroups follows"]+["%s %d %d n"%(gname,g["last"],g["first"])
+                    for gname,g in sorted(self.corpus.items()) if self.matches(gname,pattern)]+["."]
+            if kind=="OVERVIEW.FMT":
+                return ["215 Order of fields in overview database"]+OVERFMT+["."]
+            if kind=="HEADERS":
+                return ["215 Headers and metadata items supported",":","."]
+            return ["501 Unknown LIST keyword"]
+        if c=="NEWGROUPS":
+            return ["231 List of new newsgroups follows","."] #the corpus does not change
+        if c=="GROUP":
+            if not args or not args[0] in self.corpus:
+                return ["411 No such newsgroup"]
+            gname=state["group"]=args[0]
+            g=self.corpus[gname]
+            return ["211 %d %d %d %s"%(len(g["articles"]),g["first"],g["last"],gname)]
+        if c in ["HEAD","OVER","XOVER","HDR","XHDR"]:
+            gname=state.get("group")
+            if not gname:
+                return ["412 No newsgroup selected"]
+            if c=="HEAD":
+                i=int(args[0])
+                if not i in self.corpus[gname]["articles"]:
+                    return ["423 No article with that number"]
+                lines=self.corpus[gname]["articles"][i]
+                return ["221 %d %s"%(i,self.getFields(gname,i).get("message-id","<>"))]+["."+l if l.startswith(".") else l for l in lines]+["."]
+            if c in ["OVER","XOVER"]:
+                numbers=self.articleRange(gname,args[0])
+                if not numbers:
+                    return ["423 No articles in that range"]
+                return ["224 Overview information follows"]+[self.overview(gname,i) for i in numbers]+["."]
+            field=args[0].lower()
+            numbers=self.articleRange(gname,args[1])
+            if not numbers:
+                return ["423 No articles in that range"]
+            return ["225 Headers follow"]+["%d %s"%(i,self.getFields(gname,i).get(field,"")) for i in numbers]+["."]
+        return ["500 Unknown command"]
+
+    async def handle(self,reader,writer):
+        loop=asyncio.get_running_loop()
+        state={}
+        def send(lines):
+            data="".join(l+"\r\n" for l in lines).encode("latin-1",errors="replace")
+            if self.latency:
+                loop.call_later(self.latency,lambda:writer.is_closing() or writer.write(data))
+            else:
+                writer.write(data)
+        send(["200 Stand-in NNTP server ready, posting prohibited"])
+        try:
+            while True:
+                line=await reader.readline()
+                if not line:
+                    break
+                words=line.decode("latin-1").split()
+                if not words:
+                    continue
+                self.commands+=1
+                if self.service:
+                    await asyncio.sleep(self.service)
+                lines=self.respond(state,words)
+                if lines is None:
+                    debug("Dropping connection on",line.strip(),level=2)
+                    break
+                send(lines)
+                await writer.drain()
+                if words[0].upper()=="QUIT":
+                    break
+            if self.latency:
+                await asyncio.sleep(self.latency) #let the delayed responses out first
+        except (ConnectionError,OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self,host="127.0.0.1",port=PORT,started=None):
+        server=await asyncio.start_server(self.handle,host,port)
+        self.port=server.sockets[0].getsockname()[1]
+        if started:started.set()
+        async with server:
+            await server.serve_forever()
+
+    def startThread(self,host="127.0.0.1",port=0):
+        """Serves in a background thread, on a free port by default; returns the port"""
+        started=threading.Event()
+        threading.Thread(target=lambda:asyncio.run(self.serve(host,port,started)),daemon=True).start()
+        started.wait()
+        return self.port
+
+def printHelp():
+    debug("Usage: %s <command> [options]"%sys.argv[0])
+    debug(" Commands:")
+    debug("   serve [-p port] [-f corpus] [-g groups] [-n articles] [-l latency] [-s service] [-e errors] [-d drops]: serve the corpus in file 'corpus', or else a generated one of 'groups' groups (default 2) of about 'articles' articles each (default 1000), on 'port' (default %d). Responses are delayed 'latency' seconds, each command takes 'service' seconds, and fractions 'errors' and 'drops' of article commands fail or drop the connection"%PORT)
+    debug("   generate [-g groups] [-n articles] <corpus>: write a generated corpus to file 'corpus'")
+    debug("   record -s server [-p port] [-u username] [-w password] [-f first] [-n count] <group> <corpus>: record the headers of 'count' (default 1000) articles of a group at a real server, from article 'first' on or else the newest ones, adding them to file 'corpus'")
+
+if __name__=="__main__":
+    args=sys.argv[1:]
+    command=args.pop(0) if args else ""
+    if command=="serve":
+        port,fname,groups,articles=PORT,None,2,1000
+        latency,service,errors,drops=LATENCY,SERVICE,0.0,0.0
+        opts, args = getopt.getopt(args, "p:f:g:n:l:s:e:d:", [])
+        for o, a in opts:
+            if o == "-p":port = int(a)
+            elif o == "-f":fname = a
+            elif o == "-g":groups = int(a)
+            elif o == "-n":articles = int(a)
+            elif o == "-l":latency = float(a)
+            elif o == "-s":service = float(a)
+            elif o == "-e":errors = float(a)
+            elif o == "-d":drops = float(a)
+        corpus=loadCorpus(fname) if fname else syntheticCorpus(groups,articles)
+        server=StandinServer(corpus,latency,service,errors,drops)
+        debug("Serving %d groups, %d articles on port %d"%(len(corpus),sum(len(g["articles"]) for g in corpus.values()),port))
+        try:
+            asyncio.run(server.serve("127.0.0.1",port))
+        except KeyboardInterrupt:
+            pass
+    elif command=="generate":
+        groups,articles=2,1000
+        opts, args = getopt.getopt(args, "g:n:", [])
+        for o, a in opts:
+            if o == "-g":groups = int(a)
+            elif o == "-n":articles = int(a)
+        if not args:
+            printHelp()
+            sys.exit(1)
+        saveCorpus(syntheticCorpus(groups,articles),args[0])
+    elif command=="record":
+        host,port,username,password,first,count=None,119,"","",None,1000
+        opts, args = getopt.getopt(args, "s:p:u:w:f:n:", [])
+        for o, a in opts:
+            if o == "-s":host = a
+            elif o == "-p":port = int(a)
+            elif o == "-u":username = a
+            elif o == "-w":password = a
+            elif o == "-f":first = int(a)
+            elif o == "-n":count = int(a)
+        if not host or len(args)<2:
+            printHelp()
+            sys.exit(1)
+        gname,fname=args
+        corpus=loadCorpus(fname) if os.path.exists(fname) else {}
+        saveCorpus(recordCorpus(host,port,username,password,gname,first,count,corpus),fname)
+    else:
+        printHelp()
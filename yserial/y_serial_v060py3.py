@@ -266,13 +266,35 @@ _______________ TABLE OF CONTENTS:
      Base:
           _______________ Attributes and methods for database setup.
                Set path to database for all instances; db0 is default.
+               Optional performance profile, see PROFILES.
                Connection and execution methods.
+          open( self, size=None ):
+               Keep connections alive in a pool until close() is called.
+          close( self ):
+               Close pooled connections; revert to connect-per-call.
+          transaction( self ):
+               Group several calls into a single commit (or rollback).
+          iterrows( self, sql, parlist=[], size=None ):
+               Execute select sql; lazily yield its rows, size at a time.
+          setcodec( self, table, codec ):
+               Encode new objects of table with codec (None for pzdumps).
+     Codec:
+          _______________ Pickle protocol, compression level and zdict.
      Insertion( Base ):
           _______________ INSERT pz BLOB into DATABASE
-          inbatch( self, objseq, table=Base.tab0 ):
+          inbatch( self, objseq, table=Base.tab0, chunk=None, progress=None ):
                Pickle and compress sequence of annotated objects; insert.
-       *  ingenerator( self, generate_objnotes, table=Base.tab0 ):
+       *  ingenerator( self, generate_objnotes, table=Base.tab0, chunk=None,
+                                                          progress=None ):
                Pickle and compress via generator function, then insert.
+          traincodec( self, table, samples, level=1, protocol=..., size=32768 ):
+               Train a zdict on sample objects, store it, set table codec.
+          loadcodec( self, table, level=1, protocol=... ):
+               Set table codec to its latest stored zdict; None if none.
+          upbatch( self, objseq, table=Base.tab0 ):
+               Like inbatch, but replace existing rows with identical notes.
+       *  upsert( self, obj, notes='#0notes', table=Base.tab0 ):
+               Insert single object, replacing any rows with identical notes.
       **  insert( self, obj, notes='#0notes', table=Base.tab0 ):
                Pickle and compress single object; insert with annotation.
      Annex( Insertion ):
@@ -309,7 +331,8 @@ _______________ TABLE OF CONTENTS:
                Delete a table: destroys its structure, indexes, data.
      Subquery( Util, Answer, Deletion ):
           _______________ SUBQUERY table, get dictionary. POP QUEUE.
-          dicsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
+          dicsub(self, subquery='', parlist=[], table=Base.tab0, POP=False,
+                                                  limit=None, offset=0):
                Subquery table to get objects into response dictionary.
           diclast( self, m=1, table=Base.tab0, POP=False ):
                Get dictionary with last m consecutive kids in table.
@@ -317,6 +340,10 @@ _______________ TABLE OF CONTENTS:
                Get dictionary where notes match comma separated values.
        *  selectdic( self, dual=1, table=Base.tab0, POP=False ):
                Alias "selectdic":  diclast  OR diccomma.
+       *  iterdic( self, subquery='', parlist=[], table=Base.tab0, size=None ):
+               Like dicsub, but lazily yield ( kid, [tunix, notes, obj] ).
+          itercomma( self, csvstr, table=Base.tab0, wild=True, size=None ):
+               Lazily yield items where notes match comma separated values.
      Display( Subquery ):
           _______________ View subquery via pretty print
           viewsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
@@ -331,6 +358,8 @@ _______________ TABLE OF CONTENTS:
           _______________ Retrieve the latest qualified object "omax" 
           omaxsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
                Get the latest object omax which matches subquery.
+          onesub( self, subquery, parlist, table, POP, order ):
+               Get the first object by kid order which matches subquery.
           omaxlast( self, n=0, table=Base.tab0, POP=False ):
                Most quickly get the latest n-th object using key index.
           omaxcomma( self, csvstr, table=Base.tab0, wild=True, POP=False ):
@@ -341,6 +370,8 @@ _______________ TABLE OF CONTENTS:
                Retrieve a row given primary key kid, POP optional.
      Oldest( Latest ):
           _______________ Retrieve the oldest qualified object "omin" 
+          ominsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
+               Get the oldest object omin which matches subquery.
           ominfirst( self, n=0, table=Base.tab0, POP=False ):
                Most quickly get the oldest n-th object using key index.
        *  fifo( self, table=Base.tab0 ):
@@ -352,11 +383,20 @@ _______________ TABLE OF CONTENTS:
           vacuum( self ):
                Defrag entire database, i.e. all tables therein.
                     - why VACUUM?
+          compact( self, table=Base.tab0 ):
+               Keep only the latest row for each distinct notes in table.
        *  clean( self, freshdays=None, table=Base.tab0 ):
                Delete stale rows after freshdays; vacuum/defrag database.
-     Main( Annex, Oldest, Care ):
+     Keyed( Insertion, Latest ):
+          _______________ Exact-key access via the indexed notes column
+       *  put( self, key, obj, table=Base.tab0 ):
+               Store obj as the only row under exact key (notes equal key).
+      **  get( self, key, table=Base.tab0, POP=False ):
+               Get the latest object whose notes equal key exactly.
+     Main( Annex, Oldest, Care, Keyed ):
           _______________ Summary for use of a single database.
-     copysub( subquery, parlist, tablex, tabley, dbx=Base.db0, dby=Base.db0 ):
+     copysub( subquery, parlist, tablex, tabley, dbx=Base.db0, dby=Base.db0,
+                                                             progress=None ):
           Subselect from tablex, then copy to tabley (in another database).
      copylast( m, tablex, tabley, dbx=Base.db0, dby=Base.db0 ):
           Copy last m consecutive kids in tablex over to tabley.
@@ -499,11 +539,126 @@ def pzdumps( obj ):
      return zlib.compress( yPickle.dumps(obj, pickle_protocol), compress_level)
      #      as binary string.
 
-def pzloads( pzob ):
+def pzloads( pzob, zdicts={} ):
      '''Inverse of pzdumps:  decompress pz object, then unpickle.'''
-     return yPickle.loads( zlib.decompress( pzob ) )  
-     #              ^auto-detects pickle protocol.
-
+     tag = pzob[0]
+     if tag == LEGACY_ZLIB:
+          return yPickle.loads( zlib.decompress( pzob ) )
+          #              ^auto-detects pickle protocol.
+     if tag == TAG_ZLIB:
+          return yPickle.loads( zlib.decompress( pzob[1:] ) )
+     if tag == TAG_PICKLE:
+          return yPickle.loads( pzob[1:] )
+     if tag == TAG_ZDICT:
+          zid = int.from_bytes( pzob[1:5], 'big' )
+          d = zlib.decompressobj( zdict=zdicts[zid] )
+          return yPickle.loads( d.decompress( pzob[5:] ) + d.flush() )
+     raise ValueError(" !! pzloads: unknown blob codec tag %s" % tag)
+
+
+#       __________ CODECS for selectable blob encoding per table
+
+#  pzdumps writes a bare zlib stream, which always begins with byte 0x78.
+#  A Codec instead writes a one-byte TAG first, so both kinds of blobs
+#  can live in one table and pzloads tells them apart:
+
+LEGACY_ZLIB = 0x78
+TAG_PICKLE  = 0
+#             ^pickled only, no compression.
+TAG_ZLIB    = 1
+#             ^zlib at any level.
+TAG_ZDICT   = 2
+#             ^zlib with a preset dictionary, followed by its 4-byte zid.
+
+class Codec:
+     '''_______________ Pickle protocol, compression level and zdict.'''
+     #  For tiny objects zlib at level 7 costs CPU but saves almost
+     #  nothing; level 1 or no compression at all (level 0) is faster.
+     #  A preset dictionary "zdict", trained on typical records of a 
+     #  table (see Insertion.traincodec), lets zlib compress tiny 
+     #  objects well, for they need not carry their own vocabulary.
+
+     def __init__( self, level=1, protocol=yPickle.HIGHEST_PROTOCOL,
+                                                  zdict=None, zid=None ):
+          self.level    = level
+          self.protocol = protocol
+          self.zdict    = zdict
+          self.zid      = zid
+          #             ^kid of the zdict in table ZDICTS, needed to decode.
+
+     def dumps( self, obj ):
+          '''Pickle object, then compress per codec settings; tag blob.'''
+          pickled = yPickle.dumps( obj, self.protocol )
+          if self.zdict is not None:
+               c = zlib.compressobj( self.level or 1, zdict=self.zdict )
+               z = c.compress( pickled ) + c.flush()
+               return bytes([TAG_ZDICT]) + self.zid.to_bytes(4,'big') + z
+          if self.level:
+               return bytes([TAG_ZLIB]) + zlib.compress(pickled, self.level)
+          return bytes([TAG_PICKLE]) + pickled
+
+
+
+import threading
+#      ^for the thread-aware connection Pool.
+import itertools
+#      ^for chunking in Insertion.inbatch.
+import contextlib
+#      ^for Base.transaction blocks.
+
+class Pool:
+     '''_______________ Small thread-aware pool of long-lived connections.'''
+     #  A thread leases one connection and keeps it across nested leases
+     #  (e.g. a select issued while iterating), then returns it to the 
+     #  idle list.  At most size connections exist; other threads wait.
+
+     def __init__( self, connect, size ):
+          self.connect = connect
+          self.size    = size
+          self.idle    = []
+          self.count   = 0
+          self.local   = threading.local()
+          self.cond    = threading.Condition()
+          self.closed  = False
+
+     def acquire( self ):
+          '''Lease this thread's connection, creating one if needed.'''
+          depth = getattr( self.local, 'depth', 0 )
+          if depth:
+               self.local.depth = depth + 1
+               return self.local.con
+          with self.cond:
+               while not self.idle and self.count >= self.size:
+                    self.cond.wait()
+               if self.idle:
+                    con = self.idle.pop()
+               else:
+                    con = self.connect()
+                    self.count += 1
+          self.local.con   = con
+          self.local.depth = 1
+          return con
+
+     def release( self, con ):
+          '''Return a leased connection once its outermost lease ends.'''
+          self.local.depth -= 1
+          if self.local.depth:
+               return
+          self.local.con = None
+          with self.cond:
+               if self.closed:
+                    con.close()
+               else:
+                    self.idle.append( con )
+                    self.cond.notify()
+
+     def closeall( self ):
+          '''Close idle connections; leased ones close when released.'''
+          with self.cond:
+               for con in self.idle:
+                    con.close()
+               self.idle   = []
+               self.closed = True
 
 
 class Base:
@@ -516,7 +671,8 @@ class Base:
      #            Specify other such files explicitly when creating instances.
      #
      #            [ Using an in-memory database ':memory:' will not work here 
-     #              because we go in and out of connection as needed. ]
+     #              because we go in and out of connection as needed, 
+     #              unless the instance is kept open() with a pool of one. ]
 
      tab0     = 'tmptable'
      #          ^default SQL table for storing objects temporarily.
@@ -539,35 +695,172 @@ class Base:
      #  an exception.  Increase the wait if a very large amount of objects 
      #  is routinely inserted during a single session.
 
-     def __init__( self, db=db0 ):
+     POOLSIZE = 4
+     #          ^ maximum number of long-lived connections kept by open().
+     #  By default we go in and out of connection for every call, which
+     #  costs an open (and a sync on commit) per operation. After open()
+     #  connections stay alive in a Pool until close(); each thread leases
+     #  its own connection, so concurrent threads never share a cursor.
+
+     PROFILES = {
+          'durable'  : [ 'PRAGMA journal_mode = DELETE',
+                         'PRAGMA synchronous = FULL' ],
+          'balanced' : [ 'PRAGMA journal_mode = WAL',
+                         'PRAGMA synchronous = NORMAL' ],
+          'bulk'     : [ 'PRAGMA journal_mode = WAL',
+                         'PRAGMA synchronous = NORMAL',
+                         'PRAGMA cache_size = -262144',
+                         'PRAGMA mmap_size = 1073741824',
+                         'PRAGMA temp_store = MEMORY' ],
+          }
+     #  Named sets of PRAGMA statements applied to every new connection,
+     #  choose one by name as in  Main( db, profile='balanced' ).
+     #       durable:  SQLite defaults; rollback journal, sync on commit.
+     #      balanced:  write-ahead log, so readers never block the writer
+     #                 (e.g. export while collecting); sync only at
+     #                 checkpoints, a crash loses no committed data
+     #                 but a power failure may lose the latest commits.
+     #          bulk:  balanced plus a 256MB page cache, 1GB of memory
+     #                 mapped I/O and temporary tables kept in memory.
+     #  journal_mode WAL persists in the database file itself.
+
+     def __init__( self, db=db0, profile=None ):
           '''Set path to database for all instances; db0 is default.'''
           self.db = db
+          self.profile = profile
+          if profile is not None and profile not in self.PROFILES:
+               raise ValueError(" !! Base: unknown profile %s" % profile)
+          self.pool = None
+          self.tables = set()
+          #             ^tables known to exist with their notes index,
+          #              so that createtable costs nothing after the first.
+          self.txn = threading.local()
+          #          ^connection of this thread's open transaction, if any.
+          self.codecs = {}
+          self.zdicts = {}
+          #             ^codec per table (see setcodec), and zdicts by zid.
+
+     def connect( self ):
+          '''Create a fresh connection to the database file.'''
+          con = ysql.connect( self.db,    timeout = self.TIMEOUT,
+                                  isolation_level = self.TRANSACT,
+                                check_same_thread = False )
+          #               ^ pooled connections may move between threads,
+          #                 but a Pool never leases one to two at once.
+          if self.profile is not None:
+               for pragma in self.PROFILES[ self.profile ]:
+                    con.execute( pragma )
+          return con
+
+     def open( self, size=None ):
+          '''Keep connections alive in a pool until close() is called.'''
+          if self.pool is None:
+               self.pool = Pool( self.connect, size or self.POOLSIZE )
+          return self
+
+     def close( self ):
+          '''Close pooled connections; revert to connect-per-call.'''
+          if self.pool is not None:
+               self.pool.closeall()
+               self.pool = None
+
+     def __enter__( self ):
+          return self.open()
+
+     def __exit__( self, *exc_info ):
+          self.close()
+          return False
+
+     #  Typical usage of the persistent connection mode:
+     #
+     #       with Main( '/tmp/agency.sqlite' ) as demo:
+     #            demo.insert( obj, "#plan agent007 #london", 'goldfinger' )
+     #            ...
+     #
+     #  or equivalently demo.open() ... demo.close() around a session.
+
+     def lease( self ):
+          '''Get a connection: from the pool if open, else a fresh one.'''
+          con = getattr( self.txn, 'con', None )
+          if con is not None:
+               return con
+               #      ^inside transaction(), everything shares one connection.
+          if self.pool is not None:
+               return self.pool.acquire()
+          return self.connect()
+
+     def unlease( self, con ):
+          '''Give back a connection obtained by lease.'''
+          if con is getattr( self.txn, 'con', None ):
+               return
+          if self.pool is not None:
+               self.pool.release( con )
+          else:
+               con.close()
+               #   ^ very important to release lock for concurrency.
+
+     def intransaction( self ):
+          '''True while this thread is inside a transaction() block.'''
+          return getattr( self.txn, 'con', None ) is not None
+
+     @contextlib.contextmanager
+     def transaction( self ):
+          '''Group several calls into a single commit (or rollback).'''
+          if self.intransaction():
+               yield self
+               return
+               #  ^nested blocks simply join the outer transaction.
+          con = self.lease()
+          self.txn.con = con
+          try:
+               yield self
+               con.commit()
+          except:
+               con.rollback()
+               raise
+          finally:
+               self.txn.con = None
+               self.unlease( con )
+
+     #  For example, replacing a row atomically (cf. Insertion.upsert):
+     #
+     #       with demo.transaction():
+     #            demo.delete( 'agent007', 'goldfinger', wild=False )
+     #            demo.insert( obj, 'agent007', 'goldfinger' )
+     #
+     #  proceed will not commit inside the block; one commit (and one sync
+     #  to disk) happens at its end, or nothing at all upon an exception.
 
      def proceed( self, sql, parlist=[[]] ):
           '''Connect, executemany, commit, then finally close.'''
+          con = cur = None
           try:
-               con = ysql.connect( self.db,    timeout = self.TIMEOUT, 
-                                       isolation_level = self.TRANSACT )
+               con = self.lease()
                cur = con.cursor()
                cur.executemany( sql, parlist )
                #        for an empty ^parameter list, use [[]].
-               con.commit()
-               #   ^MUST remember to commit! else the data is rolled back! 
+               if not self.intransaction():
+                    con.commit()
+               #   ^MUST remember to commit! else the data is rolled back!
           except:
+               if con is not None and not self.intransaction():
+                    con.rollback()
+                    #  ^a pooled connection must not keep a failed transaction.
                a = " !! Base.proceed did not commit. [Check db path.] \n"
                b = "             Suspect busy after TIMEOUT,          \n"
                c = "             tried this sql and parameter list:   \n"
                raise IOError("%s%s%s%s\n%s" % ( a, b, c, sql, parlist ))
           finally:
-               cur.close()
-               con.close()
-               #   ^ very important to release lock for concurrency.
+               if cur is not None:
+                    cur.close()
+               if con is not None:
+                    self.unlease( con )
 
      def respond( self, klass, sql, parlist=[] ):
           '''Connect, execute select sql, get response dictionary.'''
+          con = cur = None
           try:
-               con = ysql.connect( self.db,    timeout = self.TIMEOUT, 
-                                       isolation_level = self.TRANSACT )
+               con = self.lease()
                cur = con.cursor()
                response = {}
                for tupler in cur.execute( sql, parlist ):
@@ -581,12 +874,77 @@ class Base:
                c = "           Tried this sql and parameter list: \n"
                raise IOError("%s%s%s%s\n%s" % (a, b, c, sql, parlist))
           finally:
-               cur.close()
-               con.close()
+               if cur is not None:
+                    cur.close()
+               if con is not None:
+                    self.unlease( con )
           return response
 
+     ZDICTS = 'yzdicts'
+     #        ^table keeping trained zlib preset dictionaries (zdict);
+     #         each row holds the zdict of the table named by its notes.
+
+     def setcodec( self, table, codec ):
+          '''Encode new objects of table with codec (None for pzdumps).'''
+          if codec is None:
+               self.codecs.pop( table, None )
+          else:
+               self.codecs[table] = codec
+          #  Rows written earlier in any other format remain readable.
+
+     def pack( self, obj, table=tab0 ):
+          '''Serialize object for table, per its codec or pzdumps.'''
+          codec = self.codecs.get( table )
+          if codec is None:
+               return pzdumps( obj )
+          return codec.dumps( obj )
+
+     def unpack( self, pzob ):
+          '''Inverse of pack for a blob of any table, past or present.'''
+          if pzob[0] == TAG_ZDICT:
+               zid = int.from_bytes( pzob[1:5], 'big' )
+               if zid not in self.zdicts:
+                    sql = 'SELECT pzblob FROM %s WHERE kid = ?' % self.ZDICTS
+                    for (zblob,) in self.iterrows( sql, [zid] ):
+                         self.zdicts[zid] = pzloads( zblob )
+          return pzloads( pzob, self.zdicts )
+
+     ARRAYSIZE = 1000
+     #           ^ rows fetched from the cursor at a time by iterrows.
+
+     def iterrows( self, sql, parlist=[], size=None ):
+          '''Execute select sql; lazily yield its rows, size at a time.'''
+          con = self.lease()
+          cur = con.cursor()
+          cur.arraysize = size or self.ARRAYSIZE
+          try:
+               try:
+                    cur.execute( sql, parlist )
+               except:
+                    a = " !! Base.iterrows choked, probably because    \n"
+                    b = "             object feels out of context.     \n"
+                    c = "           Tried this sql and parameter list: \n"
+                    raise IOError("%s%s%s%s\n%s" % (a, b, c, sql, parlist))
+               while True:
+                    rows = cur.fetchmany()
+                    if not rows:
+                         break
+                    for tupler in rows:
+                         yield tupler
+          finally:
+               cur.close()
+               self.unlease( con )
+
+          #  Unlike respond, memory use does not grow with the number of 
+          #  rows.  The connection stays leased while the caller iterates, 
+          #  so keep the instance open() if other calls are made in the 
+          #  loop: they then share that connection instead of waiting on 
+          #  its read lock.
+
      def createtable( self, table=tab0 ):
           '''Columns created: key ID, unix time, notes, and pzblob.'''
+          if table in self.tables:
+               return
           a = 'CREATE TABLE IF NOT EXISTS %s' % table
           b = '(kid INTEGER PRIMARY KEY, tunix INTEGER,'
           c = 'notes TEXT, pzblob BLOB)'
@@ -600,6 +958,22 @@ class Base:
                     print(" :: createtable: table exists.")
           #    createtable is designed to be harmless if it 
           #    left sitting in your script.
+          self.createindex( table )
+
+     def createindex( self, table=tab0 ):
+          '''Index the notes column, for exact-key lookups; True if done.'''
+          sql = 'CREATE INDEX IF NOT EXISTS %s_notes ON %s (notes)' % (
+                                                               table, table )
+          try:
+               self.proceed( sql )
+          except IOError:
+               if DEBUG:
+                    print(" :: createindex: no such table.")
+               return False
+          self.tables.add( table )
+          return True
+          #  GLOB with a leading wildcard can never use this index, 
+          #  but "notes = ?" (see class Keyed) becomes a B-tree search.
 
 
 
@@ -612,7 +986,10 @@ class Insertion( Base ):
      #       objseq = [ (obj1, 'First thing'), (obj2, 'Second thing') ]
      #  Use an empty string like "" to explicitly blank out annotation.
 
-     def inbatch( self, objseq, table=Base.tab0 ):
+     CHUNKSIZE = 10000
+     #           ^ objects pickled, held in memory and committed at a time.
+
+     def inbatch( self, objseq, table=Base.tab0, chunk=None, progress=None ):
           '''Pickle and compress sequence of annotated objects; insert.'''
           self.createtable( table ) 
           #    ^ serves also to check table's existence.
@@ -620,28 +997,97 @@ class Insertion( Base ):
           v  = "VALUES (null, strftime('%s','now'), ?, ?)"
           #                   ^SQLite's function for unix epoch time.
           sql = ' '.join([s, v])
-          def generate_parlist():
-               for i in objseq:
-                    obj, notes = i
-                    parlist  = [ notes, ysql.Binary(pzdumps(obj)) ]
-                    yield parlist
-                    #     ^ using generator for parameter list.
-          self.proceed( sql, generate_parlist() ) 
+          objiter = iter( objseq )
+          #         any iterable will do, and is consumed only once.
+          chunk = chunk or self.CHUNKSIZE
+          done  = 0
+          while True:
+               parlist = [ [ notes, ysql.Binary(self.pack(obj, table)) ]
+                      for obj, notes in itertools.islice( objiter, chunk ) ]
+               if not parlist:
+                    break
+               self.proceed( sql, parlist ) 
+               #    commits each chunk, unless inside a transaction.
+               done += len( parlist )
+               if progress is not None:
+                    progress( done )
+          return done
           #    inserting 100,000 rows takes about 10 seconds.
 
+     #  Memory use is bounded by chunk, so even millions of objects can be
+     #  inserted. If objseq fails midway, the chunks before stay committed.
+     #  progress, if given, is called with the running count of inserted
+     #  objects after each commit, e.g.  progress=print
+
      #  objseq can be generated on the fly. Just write a generator function, 
      #  and pass it along to pzgenerator [for illustration, see copy].
 
-     def ingenerator( self, generate_objnotes, table=Base.tab0 ):
+     def ingenerator( self, generate_objnotes, table=Base.tab0, chunk=None,
+                                                           progress=None ):
           '''Pickle and compress via generator function, then insert.'''
           #  generator should yield an objseq element like this: (obj, notes)
-          self.inbatch( [x for x in generate_objnotes], table )
+          return self.inbatch( generate_objnotes, table, chunk, progress )
 
           #  TIP:  generate computationally intense results, then 
           #  pass them to ingenerator which will warehouse them. Instantly 
           #  access those pre-computed results later by subquery on notes.
 
 
+     def traincodec( self, table, samples, level=1, 
+                           protocol=yPickle.HIGHEST_PROTOCOL, size=32768 ):
+          '''Train a zdict on sample objects, store it, set table codec.'''
+          pickled = b''.join([ yPickle.dumps(obj, protocol) for obj in samples ])
+          zdict   = pickled[-size:]
+          #         zlib only looks back 32K, and prefers the dictionary's
+          #         end for the most common strings; samples last in count.
+          self.insert( zdict, table, self.ZDICTS )
+          zid = self.lastkid( self.ZDICTS )
+          self.zdicts[zid] = zdict
+          codec = Codec( level, protocol, zdict, zid )
+          self.setcodec( table, codec )
+          return codec
+
+     def loadcodec( self, table, level=1, protocol=yPickle.HIGHEST_PROTOCOL ):
+          '''Set table codec to its latest stored zdict; None if none.'''
+          a = 'SELECT kid, pzblob FROM %s WHERE notes = ?'
+          b = 'ORDER BY kid DESC LIMIT 1'
+          sql = ' '.join([ a % self.ZDICTS, b ])
+          try:
+               rows = list( self.iterrows( sql, [table] ) )
+          except IOError:
+               rows = []
+               #  ^no zdict was ever trained in this database.
+          if not rows:
+               return None
+          zid, zblob = rows[0]
+          self.zdicts[zid] = pzloads( zblob )
+          codec = Codec( level, protocol, self.zdicts[zid], zid )
+          self.setcodec( table, codec )
+          return codec
+
+     #  Older zdicts are never deleted since existing rows refer to them.
+
+     def upbatch( self, objseq, table=Base.tab0 ):
+          '''Like inbatch, but replace existing rows with identical notes.'''
+          objseq = list( objseq )
+          self.createtable( table )
+          sql = "DELETE FROM %s WHERE notes = ?" % table
+          #     uses the notes index created by createtable.
+          with self.transaction():
+               self.proceed( sql, [ [notes] for obj, notes in objseq ] )
+               self.inbatch( objseq, table )
+          #  Exactly one live row per notes, with a fresh kid and tunix.
+          #  Should the same notes occur twice within objseq, 
+          #  both of those rows are kept.
+
+     def upsert( self, obj, notes='#0notes', table=Base.tab0 ):
+          '''Insert single object, replacing any rows with identical notes.'''
+          self.upbatch( [(obj, notes)], table )
+
+     #  Use upsert instead of insert for state which is rewritten often,
+     #  e.g. a counter or pointer kept under a fixed label: insert would 
+     #  append one more row per write, and the table would grow forever.
+
      def insert( self, obj, notes='#0notes', table=Base.tab0 ):
           '''Pickle and compress single object; insert with annotation.'''
           self.inbatch( [(obj, notes)], table )
@@ -716,7 +1162,7 @@ class Answer( Base ):
                #        ^ we only expect a single answer.
           if klass == 'Subquery':
                kid, tunix, notes, pzblob  =  tupler
-               obj = pzloads( pzblob )
+               obj = self.unpack( pzblob )
                response[kid] = [ tunix, notes, obj ]
                #  each item in response DICTIONARY has a key kid          <= 
                #  (same as in the table), and it is a list consisting of  <= 
@@ -878,6 +1324,7 @@ class Deletion( Base, Util ):
      def droptable( self, table=Base.tab0 ):
           '''Delete a table: destroys its structure, indexes, data.'''
           sql = 'DROP TABLE %s' % table 
+          self.tables.discard( table )
           try:
                self.proceed( sql ) 
           except:
@@ -903,15 +1350,44 @@ class Subquery( Answer, Deletion ):
      #            corresponds to the placeholder(s).
      #            parlist should be empty [] if no placeholders are used.
 
-     def dicsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
+     def dicsub(self, subquery='', parlist=[], table=Base.tab0, POP=False,
+                                                    limit=None, offset=0):
           '''Subquery table to get objects into response dictionary.'''
           a = 'SELECT kid, tunix, notes, pzblob FROM %s %s'
           sql = a % ( table, subquery )
+          if limit is not None:
+               sql += ' LIMIT ? OFFSET ?'
+               parlist = list( parlist ) + [ limit, offset ]
           response = self.respond( 'Subquery', sql, parlist )
           if POP:
-               self.deletesub( subquery, parlist, table )
+               if limit is None:
+                    self.deletesub( subquery, parlist, table )
+               else:
+                    self.proceed( 'DELETE FROM %s WHERE kid = ?' % table,
+                                  [ [kid] for kid in response ] )
+                    #  ^only the page retrieved, not all that matched.
           return response
 
+     #  For paging through many matches, limit the number of objects 
+     #  decompressed at once, and end the subquery by an ORDER BY, e.g.
+     #       dicsub( 'WHERE notes GLOB ? ORDER BY kid', ['*#tag*'], 
+     #                                  table, limit=100, offset=200 )
+
+     def iterdic( self, subquery='', parlist=[], table=Base.tab0, size=None ):
+          '''Like dicsub, but lazily yield ( kid, [tunix, notes, obj] ).'''
+          a = 'SELECT kid, tunix, notes, pzblob FROM %s %s'
+          sql = a % ( table, subquery )
+          for kid, tunix, notes, pzblob in self.iterrows( sql, parlist, size ):
+               yield kid, [ tunix, notes, self.unpack( pzblob ) ]
+               #  same items as dicsub(...).items(), in kid order,
+               #  but only size of them are ever held in memory.
+
+     def itercomma( self, csvstr, table=Base.tab0, wild=True, size=None ):
+          '''Lazily yield items where notes match comma separated values.'''
+          parlist  = self.comma2list( csvstr, wild )
+          subquery = self.notesglob( parlist )
+          return self.iterdic( subquery, parlist, table, size )
+
      #       __________ Using POP for QUEUE purposes         ___ATTN___ 
      #
      #  After y_serial retrieves entities that match a subquery pattern, 
@@ -1009,23 +1485,31 @@ class Latest( Display ):
 
      def omaxsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
           '''Get the latest object omax which matches subquery.'''
-          dic = self.dicsub( subquery, parlist, table )
-          dickeylist = self.reverse_dickeys( dic )
+          return self.onesub( subquery, parlist, table, POP, 'DESC' )
+
+     def onesub( self, subquery, parlist, table, POP, order ):
+          '''Get the first object by kid order which matches subquery.'''
+          latest = ' '.join([ subquery, 'ORDER BY kid', order ])
+          dic = self.dicsub( latest, parlist, table, limit=1 )
+          #    SQLite sorts (by primary key, so usually for free) and 
+          #    only one matching object is ever decompressed; thus 
+          #    subquery itself must not contain ORDER BY or LIMIT.
+          dickeylist = list( dic.keys() )
           diclen  = len( dickeylist )
-          #         count how many matched subquery
+          #         count how many matched subquery, i.e. 0 or 1.
           if diclen:
-               keymax = dickeylist[0]
-               # ^MAX DIC KEY of the LATEST matching subquery.
-               #        dic[keymax][0] corresponds to tunix.
-               #        dic[keymax][1] corresponds to notes.
-               omax   = dic[keymax][2]
-               #  ^this is the LATEST OBJECT matching subquery.
+               keyone = dickeylist[0]
+               # ^DIC KEY of the LATEST (or OLDEST) matching subquery.
+               #        dic[keyone][0] corresponds to tunix.
+               #        dic[keyone][1] corresponds to notes.
+               oone   = dic[keyone][2]
+               #  ^this is the LATEST (or OLDEST) OBJECT matching subquery.
                if POP:
                #    ^queue-like deletion of only single object:
-                    self.deletekid( keymax, table )
+                    self.deletekid( keyone, table )
           else:
-               omax = None
-          return omax
+               oone = None
+          return oone
 
      def omaxlast( self, n=0, table=Base.tab0, POP=False ):
           '''Most quickly get the latest n-th object using key index.'''
@@ -1068,12 +1552,15 @@ class Latest( Display ):
 class Oldest( Latest ):
      '''_______________ Retrieve the oldest qualified object "omin" '''
 
+     def ominsub(self, subquery='', parlist=[], table=Base.tab0, POP=False):
+          '''Get the oldest object omin which matches subquery.'''
+          return self.onesub( subquery, parlist, table, POP, 'ASC' )
+
      def ominfirst( self, n=0, table=Base.tab0, POP=False ):
           '''Most quickly get the oldest n-th object using key index.'''
           #               n = 0,1,2,...  assuming consecutive kids.
           subquery = "WHERE kid=(SELECT MIN(kid) + ? FROM %s)" % table
-          obj = self.omaxsub( subquery, [n], table, POP )
-          #          ^works because its dictionary is single entry.
+          obj = self.ominsub( subquery, [n], table, POP )
           if DEBUG and obj == None:
                print(" !! ominfirst: that kid does not exist.")
           return obj
@@ -1119,6 +1606,15 @@ class Care( Answer, Deletion ):
           #  the database file structure." -- sqlite.org
           #  N.B. -  Surprising how much file size will shrink.
 
+     def compact( self, table=Base.tab0 ):
+          '''Keep only the latest row for each distinct notes in table.'''
+          sub = 'WHERE kid NOT IN (SELECT MAX(kid) FROM %s GROUP BY notes)'
+          self.deletesub( sub % table, [], table )
+
+          #  One-shot remedy for tables which grew by repeated insert 
+          #  of the same notes, before upsert was available. 
+          #  Follow with vacuum to actually shrink the file.
+
      def clean( self, freshdays=None, table=Base.tab0 ):
           '''Delete stale rows after freshdays; vacuum/defrag database.'''
           self.freshen( freshdays, table )
@@ -1127,7 +1623,28 @@ class Care( Answer, Deletion ):
 
 
 
-class Main( Annex, Oldest, Care ):
+class Keyed( Insertion, Latest ):
+     '''_______________ Exact-key access via the indexed notes column'''
+     #  select() turns a string into "notes GLOB '*key*'", which scans 
+     #  and decompresses the whole table, and also matches any notes 
+     #  merely containing key.  When notes are used as a unique key, 
+     #  as in  put( 'agent007', obj, 'goldfinger' ), prefer get/put.
+
+     def put( self, key, obj, table=Base.tab0 ):
+          '''Store obj as the only row under exact key (notes equal key).'''
+          self.upsert( obj, key, table )
+
+     def get( self, key, table=Base.tab0, POP=False ):
+          '''Get the latest object whose notes equal key exactly.'''
+          if table not in self.tables:
+               self.createindex( table )
+               #    ^older tables may predate the index; a missing table
+               #     is left missing so that the subquery raises IOError.
+          return self.omaxsub( 'WHERE notes = ?', [ key ], table, POP )
+
+
+
+class Main( Annex, Oldest, Care, Keyed ):
      '''_______________ Summary for use of a single database.'''
      pass
      #                  Base
@@ -1141,34 +1658,34 @@ class Main( Annex, Oldest, Care ):
      #         Latest(Display)
      #  Oldest(Latest)
      #                                  Care(Answer, Deletion)
+     #                         Keyed(Insertion, Latest)
 
 
 
 #  _______________ COPY functions (demonstration outside of Main class)
 #                       also note how ingenerator is employed usefully.
 
-def copysub( subquery, parlist, tablex, tabley, dbx=Base.db0, dby=Base.db0 ):
+def copysub( subquery, parlist, tablex, tabley, dbx=Base.db0, dby=Base.db0,
+                                                              progress=None ):
      '''Subselect from tablex, then copy to tabley (in another database).'''
      #          assume tablex is in dbx, and tabley is in dby;
      #          copying from *x to *y.
      if (tablex != tabley) or (dbx != dby):
           X = Main( dbx )
-          dic = X.dicsub( subquery, parlist, tablex )
-          dickeylist = X.reverse_dickeys( dic, recentfirst=False )
-          #                     order keys chronologically ^
-          #                     to preserve inserted ordering on copy.
-          diclen  = len( dickeylist )
-          #         count how many matched subquery
-          if diclen:
+          if dbx == dby:
+               Y = X
+               #  ^one database: reading and writing must share the pooled
+               #   connection, else commits wait on our own read lock.
+          else:
                Y = Main( dby )
-               def generate_objnotes():
-                    for i in dickeylist:
-                         notes = dic[i][1]
-                         obj   = dic[i][2]
-                         yield (obj, notes)
-               Y.ingenerator( generate_objnotes(), tabley )
-               #   generator copies objects & notes from qualified dictionary.
+          with X:
+               objnotes = ( (obj, notes) for kid, [tunix, notes, obj] in
+                       X.iterdic( subquery + ' ORDER BY kid', parlist, tablex ) )
+               #     order kids chronologically to preserve inserted ordering.
+               diclen = Y.ingenerator( objnotes, tabley, progress=progress )
+               #   generator streams objects & notes in bounded memory.
                #   Timestamps are fresh, i.e. not preserved from old table.
+          if diclen:
                if DEBUG:
                     p = ( diclen, tablex, tabley )
                     print(" :: copysub:  %s objects from %s to %s." % p)
@@ -1899,6 +2416,13 @@ def tester( database=Base.db0 ):
           ipass += 1
      else:
           print("TEST FAIL!   comma2list with wild=True.")
+     print("     Trying exact-key .get ...")
+     got5 = I.get( 'test dictionary', 'ytest' )
+     if got5 == tmp2 and I.get( 'test', 'ytest' ) == None:
+          print("passed test: get by exact key.")
+          ipass += 1
+     else:
+          print("TEST FAIL!   get by exact key.")
      # ================================================================== 
      print("     (Note: infile v0.50 has passed inspection.)")
      #  Test infile separately since it requires an external file.
@@ -1938,7 +2462,7 @@ def tester( database=Base.db0 ):
      ipass += 1
      print("----------------------------------------------------------------")
      #  print "ipass =", ipass
-     if ipass == 20:
+     if ipass == 21:
           #      ^increment if you added a test ;-)
           print(" *** tester    compiled: PASSED -- verify results above. ***")
      else: